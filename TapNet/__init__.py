@@ -0,0 +1,4 @@
+import logging
+
+# Log output is off unless the application configures logging
+logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -0,0 +1,288 @@
+import asyncio
+import inspect
+import json
+import logging
+import time
+
+from TapNet.netLibrary import Server, Client, INTEGRITY_SHA256, COMPRESSION_NONE, _CongestionWindow, \
+    _DEFAULT_CHUNK_SIZE, _MAX_CHUNK_SIZE, _COMPRESSION_SHIFT
+
+_logger = logging.getLogger(__name__)
+
+
+# asyncio versions of Server and Client. Wire format, reassembly and ACK bookkeeping are the ones of netLibrary,
+# only the socket I/O and the timers are replaced by a datagram transport and loop callbacks.
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, owner):
+        self._owner = owner
+
+    def connection_made(self, transport):
+        self._owner._transport = transport
+
+    def datagram_received(self, data, addr):
+        self._owner._handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        _logger.error('Datagram transport error: %s', exc)
+
+
+class PackageStream:
+    # Async iterator over the contiguous byte ranges of one incoming package, in order.
+    # release(size) is called as queued ranges are consumed (or dropped once the consumer is done).
+    def __init__(self, unique_identifier, release=None):
+        self.unique_identifier = unique_identifier
+        self._queue = asyncio.Queue()
+        self._release = release
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            raise item
+        if self._release is not None:
+            self._release(len(item))
+        return item
+
+    def _put(self, item):
+        self._queue.put_nowait(item)
+
+    def _drop(self):
+        # The consumer returned without reading everything, what is left must not stay counted
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if isinstance(item, bytes) and self._release is not None:
+                self._release(len(item))
+
+
+class AsyncServer(Server):
+    # A coroutine stream_handler(unique_identifier, stream) is started once per incoming package and iterates a
+    # PackageStream, a plain stream_handler gets the same ranged calls as in Server.
+    # Ranges queued for slow stream consumers count against max_buffer_memory along with the partial packages.
+    # Once it is used up new chunks are not accepted: reliable ones are not acknowledged (the client resends them)
+    # and normal ones are dropped.
+    def __init__(self, address=None, port=None, handler=None, max_buffer_memory=Server._MAX_BUFFER_MEMORY,
+                 package_timeout=Server._PACKAGE_TIMEOUT, stream_handler=None, max_chunk_size=_MAX_CHUNK_SIZE,
+                 deliver_batches=False):
+        super().__init__(address, port, handler, max_buffer_memory, package_timeout, stream_handler,
+                         max_chunk_size=max_chunk_size, deliver_batches=deliver_batches)
+        self._transport = None
+        self._handler_tasks = set()
+        self._streams = {}
+        self._max_buffer_memory = max_buffer_memory
+        # Bytes waiting in PackageStreams
+        self._stream_memory = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: _DatagramProtocol(self), local_addr=(self.address, self.port))
+        _logger.info('Server bound on port %s, host %s', self.port, self.address)
+
+    async def serve_forever(self):
+        await self.start()
+        await asyncio.Future()
+
+    def end(self):
+        if self._transport is not None:
+            self._transport.close()
+        _logger.info('Connection closed.')
+
+    def _create_socket(self):
+        return None
+
+    def _sendto(self, data, address):
+        self._transport.sendto(data, address)
+
+    def stats(self):
+        stats = super().stats()
+        stats['stream_memory'] = self._stream_memory
+        return stats
+
+    def _schedule_ack_flush(self):
+        # There is no received batch, pending selective ACKs go out once the datagrams already queued are handled
+        asyncio.get_running_loop().call_soon(self._flush_acks)
+
+    def _deliver(self, data, unique_identifier=None, reliable=True):
+        # The handler can be a plain function or a coroutine function
+        result = self._response_handler(data)
+        if inspect.isawaitable(result):
+            self._start_handler_task(result)
+
+    def _deliver_range(self, unique_identifier, offset, data, completed):
+        if not inspect.iscoroutinefunction(self._stream_handler):
+            super()._deliver_range(unique_identifier, offset, data, completed)
+            return
+        stream = self._streams.get(unique_identifier)
+        if stream is None:
+            stream = self._streams[unique_identifier] = PackageStream(unique_identifier, self._release_stream_memory)
+            task = self._start_handler_task(self._stream_handler(unique_identifier, stream))
+            task.add_done_callback(lambda _: stream._drop())
+        # The datagram buffer is reused after this call, the consumer gets its own copy
+        stream._put(bytes(data))
+        self._stream_memory += len(data)
+        if completed:
+            stream._put(None)
+            del self._streams[unique_identifier]
+
+    def _discard_range(self, unique_identifier, offset):
+        if not inspect.iscoroutinefunction(self._stream_handler):
+            super()._discard_range(unique_identifier, offset)
+            return
+        stream = self._streams.pop(unique_identifier, None)
+        if stream is not None:
+            stream._put(TimeoutError(f'Package {unique_identifier} discarded before completion'))
+
+    def _release_stream_memory(self, size):
+        self._stream_memory -= size
+
+    def _memory_full(self):
+        return self._stream_memory > 0 and \
+            self._stream_memory + self._packages.memory_used >= self._max_buffer_memory
+
+    def _acks_paused(self):
+        return super()._acks_paused() or self._memory_full()
+
+    def _parse_datagram(self, datagram, address, reliable=False):
+        if not reliable and self._memory_full():
+            self._datagrams_dropped += 1
+            return
+        super()._parse_datagram(datagram, address, reliable)
+
+    def _start_handler_task(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_tasks.discard)
+        return task
+
+
+class _AsyncCongestionWindow(_CongestionWindow):
+    def __init__(self, initial_rto):
+        super().__init__(initial_rto)
+        self._slot_released = asyncio.Event()
+
+    async def acquire_slot(self):
+        while self.in_flight >= int(self.size):
+            self._slot_released.clear()
+            try:
+                await asyncio.wait_for(self._slot_released.wait(), self.rto)
+            except asyncio.TimeoutError:
+                pass
+        self.in_flight += 1
+
+    def release_slot(self, count=1):
+        super().release_slot(count)
+        self._slot_released.set()
+
+    def on_acks(self, count, rtt_sample=None):
+        super().on_acks(count, rtt_sample)
+        self._slot_released.set()
+
+
+class AsyncClient(Client):
+    # Chunk size discovery needs a blocking wait and batching a linger thread, they are only available in the
+    # threaded Client
+    def __init__(self, address=None, address_port=None, local_port=None, integrity=INTEGRITY_SHA256,
+                 chunk_size=_DEFAULT_CHUNK_SIZE, sack=False, compression=COMPRESSION_NONE):
+        super().__init__(address, address_port, local_port, integrity, chunk_size, sack=sack, compression=compression)
+        self._congestion = _AsyncCongestionWindow(self._AWAIT_TIME)
+        self._transport = None
+        self._loop = None
+        self._start_task = None
+        # package_id -> future resolved once every chunk is acknowledged
+        self._package_futures = {}
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self._loop.create_datagram_endpoint(lambda: _DatagramProtocol(self),
+                                                  local_addr=('localhost', self._local_port))
+        self._is_bound = True
+        _logger.info('Socket bound on port %s, host %s', self._local_port, self.address)
+
+    async def send_json(self, data, datagram_type, destination):
+        json_bytes = json.dumps(data).encode(encoding='utf-8')
+        await self.send_data(json_bytes, datagram_type, destination)
+
+    async def send_data(self, data, datagram_type, destination):
+        if not self._is_bound:
+            # Concurrent first sends must bind only once
+            if self._start_task is None:
+                self._start_task = asyncio.ensure_future(self.start())
+            await self._start_task
+
+        unique_package_id = self._package_ID
+        self._package_ID += 1
+
+        is_reliable = datagram_type == self._DATAGRAM_RELIABLE
+        data, compression = self._compress_payload(data)
+        number_of_subpackages, chunks = self._split(data)
+
+        if is_reliable:
+            self._initialize_structure_for_reliable(number_of_subpackages, unique_package_id, destination)
+            done = self._loop.create_future()
+            self._package_futures[unique_package_id] = done
+
+        package_hash = self._new_package_hash()
+        package = self._reliable_datagrams_info.get(unique_package_id) if is_reliable else None
+        for i, chunk in enumerate(chunks):
+            header = self._pack_header(datagram_type, unique_package_id, number_of_subpackages, i, chunk,
+                                       package_hash=package_hash, buffer=package.header(i) if is_reliable else None,
+                                       options=compression << _COMPRESSION_SHIFT)
+            if is_reliable:
+                await self._congestion.acquire_slot()
+                package.chunks[i] = chunk
+                package.last_send_time[i] = time.time()
+                self._schedule_retransmission(unique_package_id, i, time.time() + self._congestion.rto)
+            self._send_datagram(header, chunk, destination)
+            self._datagrams_sent += 1
+            self._bytes_sent += len(chunk)
+
+        if is_reliable:
+            await done
+
+    async def flush(self, timeout=None):
+        pending = list(self._package_futures.values())
+        if not pending:
+            return True
+        done, _ = await asyncio.wait(pending, timeout=timeout)
+        # Failed packages raise in their send_data, here they only make the flush fail
+        return len(done) == len(pending) and not any(future.exception() for future in done)
+
+    async def close(self):
+        await self.flush()
+        self._is_closed = True
+        if self._transport is not None:
+            self._transport.close()
+        _logger.info('Socket closed on port %s, host %s', self._local_port, self.address)
+
+    def _create_socket(self):
+        return None
+
+    def _send_datagram(self, header, payload, address):
+        # Datagram transports have no scatter/gather send
+        self._transport.sendto(b''.join((header, payload)), address)
+
+    def _handle_datagram(self, datagram, address):
+        self._dispatch_datagram(datagram, address)
+
+    def _clean_package_register(self, package_id, failed=False):
+        super()._clean_package_register(package_id, failed)
+        done = self._package_futures.pop(package_id, None)
+        if done is not None and not done.done():
+            if failed:
+                done.set_exception(ConnectionError(f'Package {package_id} failed, some chunks were given up'))
+            else:
+                done.set_result(None)
+
+    def _schedule_retransmission(self, package_id, subpackage_id, deadline):
+        self._loop.call_later(max(deadline - time.time(), 0), self._on_retransmission_timer, package_id, subpackage_id)
+
+    def _on_retransmission_timer(self, package_id, subpackage_id):
+        if self._is_closed:
+            return
+        if self._resend_data(package_id, subpackage_id):
+            self._congestion.on_timeout()
@@ -0,0 +1,195 @@
+import ctypes
+import os
+import select
+import sys
+from socket import AF_INET, inet_aton, inet_ntoa, htons, ntohs
+import socket as _socket
+
+
+# Bulk datagram I/O: many datagrams per wakeup. recvmmsg/sendmmsg are used through ctypes where libc has them,
+# otherwise the socket is drained with recvfrom_into over preallocated buffers until it would block.
+
+_MSG_WAITFORONE = 0x10000
+_MSG_DONTWAIT = getattr(_socket, 'MSG_DONTWAIT', 0)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_ubyte * 4), ('sin_zero', ctypes.c_ubyte * 8)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+class _PyBuffer(ctypes.Structure):
+    _fields_ = [('buf', ctypes.c_void_p), ('obj', ctypes.c_void_p), ('len', ctypes.c_ssize_t),
+                ('itemsize', ctypes.c_ssize_t), ('readonly', ctypes.c_int), ('ndim', ctypes.c_int),
+                ('format', ctypes.c_char_p), ('shape', ctypes.c_void_p), ('strides', ctypes.c_void_p),
+                ('suboffsets', ctypes.c_void_p), ('internal', ctypes.c_void_p)]
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return libc
+
+
+_libc = _load_libc()
+
+if _libc is not None:
+    _get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+    _get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_PyBuffer), ctypes.c_int]
+    _release_buffer = ctypes.pythonapi.PyBuffer_Release
+    _release_buffer.argtypes = [ctypes.POINTER(_PyBuffer)]
+
+
+class DatagramIO:
+    _BATCH_SIZE = 64
+    _ADDRESS_CACHE_SIZE = 4096
+
+    def __init__(self, sock, buffer_size=4096, batch_size=_BATCH_SIZE):
+        self._socket = sock
+        self._buffer_size = buffer_size
+        self._batch_size = batch_size
+        self._block = bytearray(buffer_size * batch_size)
+        self._views = [memoryview(self._block)[i * buffer_size:(i + 1) * buffer_size] for i in range(batch_size)]
+        # Raw sockaddr -> (host, port), to avoid building a new tuple for every datagram
+        self._addresses = {}
+        self._sockaddrs = {}
+        self.batched = _libc is not None
+        if self.batched:
+            self._prepare_recvmmsg()
+
+    def recv_batch(self):
+        # Blocks until one datagram is available and returns it along with every other already queued one.
+        # The returned views are overwritten by the next call.
+        if self.batched:
+            return self._recvmmsg()
+        return self._recv_drain()
+
+    def send_batch(self, datagrams):
+        # datagrams: list of (buffers, address), every datagram is the concatenation of its buffers
+        if not datagrams:
+            return
+        if self.batched:
+            self._sendmmsg(datagrams)
+            return
+        for buffers, address in datagrams:
+            if hasattr(self._socket, 'sendmsg'):
+                self._socket.sendmsg(buffers, (), 0, address)
+            else:
+                self._socket.sendto(b''.join(buffers), address)
+
+    def _prepare_recvmmsg(self):
+        count = self._batch_size
+        self._iovecs = (_IOVec * count)()
+        self._names = (_SockaddrIn * count)()
+        self._messages = (_MMsgHdr * count)()
+        for i in range(count):
+            self._iovecs[i].iov_base = ctypes.addressof(ctypes.c_char.from_buffer(self._block, i * self._buffer_size))
+            self._iovecs[i].iov_len = self._buffer_size
+            header = self._messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(self._names[i])
+            header.msg_iov = ctypes.pointer(self._iovecs[i])
+            header.msg_iovlen = 1
+
+    def _recvmmsg(self):
+        for i in range(self._batch_size):
+            self._messages[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+        received = _libc.recvmmsg(self._socket.fileno(), self._messages, self._batch_size, _MSG_WAITFORONE, None)
+        if received < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return [(self._views[i][:self._messages[i].msg_len], self._address(self._names[i]))
+                for i in range(received)]
+
+    def _address(self, name):
+        key = bytes(name)[2:8]
+        address = self._addresses.get(key)
+        if address is None:
+            if len(self._addresses) > self._ADDRESS_CACHE_SIZE:
+                self._addresses.clear()
+            address = self._addresses[key] = (inet_ntoa(bytes(name.sin_addr)), ntohs(name.sin_port))
+        return address
+
+    def _recv_drain(self):
+        result = []
+        flags = 0
+        for view in self._views:
+            if flags == 0 and result and not select.select([self._socket], [], [], 0)[0]:
+                break
+            try:
+                size, address = self._socket.recvfrom_into(view, self._buffer_size, flags)
+            except BlockingIOError:
+                break
+            result.append((view[:size], address))
+            flags = _MSG_DONTWAIT
+        return result
+
+    def _sockaddr(self, address):
+        sockaddr = self._sockaddrs.get(address)
+        if sockaddr is None:
+            if len(self._sockaddrs) > self._ADDRESS_CACHE_SIZE:
+                self._sockaddrs.clear()
+            host = _socket.gethostbyname(address[0])
+            sockaddr = _SockaddrIn(AF_INET, htons(address[1]), (ctypes.c_ubyte * 4)(*inet_aton(host)))
+            self._sockaddrs[address] = sockaddr
+        return sockaddr
+
+    def _sendmmsg(self, datagrams):
+        count = len(datagrams)
+        iovec_count = sum(len(buffers) for buffers, _ in datagrams)
+        messages = (_MMsgHdr * count)()
+        iovecs = (_IOVec * iovec_count)()
+        # The buffers are pinned (not copied) while the kernel reads them
+        pinned = []
+        # The address cache can be cleared in the middle of the batch, the messages keep their own references
+        names = []
+        try:
+            position = 0
+            for i, (buffers, address) in enumerate(datagrams):
+                header = messages[i].msg_hdr
+                names.append(self._sockaddr(address))
+                header.msg_name = ctypes.addressof(names[-1])
+                header.msg_namelen = ctypes.sizeof(_SockaddrIn)
+                header.msg_iov = ctypes.pointer(iovecs[position])
+                header.msg_iovlen = len(buffers)
+                for buffer in buffers:
+                    view = _PyBuffer()
+                    _get_buffer(buffer, ctypes.byref(view), 0)
+                    pinned.append(view)
+                    iovecs[position].iov_base = view.buf
+                    iovecs[position].iov_len = view.len
+                    position += 1
+
+            sent = 0
+            while sent < count:
+                result = _libc.sendmmsg(self._socket.fileno(), ctypes.byref(messages[sent]), count - sent, 0)
+                if result < 0:
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno))
+                sent += result
+        finally:
+            for view in pinned:
+                _release_buffer(ctypes.byref(view))
@@ -0,0 +1,125 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread, Condition, current_thread
+
+
+# Runs the handler of completed packages off the receive thread. Packages wait in a bounded queue, what happens
+# when it is full depends on the backpressure policy:
+#   BACKPRESSURE_BLOCK        the receive thread waits for a free slot (the kernel buffers, then drops, datagrams)
+#   BACKPRESSURE_DROP_OLDEST  the oldest queued package is discarded to make room
+#   BACKPRESSURE_PAUSE_ACKS   the Server stops accepting (and acknowledging) reliable chunks until there is room,
+#                             so senders time out and shrink their congestion windows. The receive thread never
+#                             waits: packages that complete while paused were already acknowledged, they are queued
+#                             over the limit (at most one per package being reassembled). Packages that were not
+#                             acknowledged (NORMAL ones) are dropped instead.
+
+BACKPRESSURE_BLOCK = 'block'
+BACKPRESSURE_DROP_OLDEST = 'drop_oldest'
+BACKPRESSURE_PAUSE_ACKS = 'pause_acks'
+
+_logger = logging.getLogger(__name__)
+
+
+class HandlerPool:
+    # With processes=True the handler runs in a process pool of the same size, it has to be picklable (a module
+    # level function) and gets a copy of the data. The threads then only wait for the results.
+    # observe(seconds) is called with the duration of every handler call.
+    def __init__(self, handler, workers=1, queue_size=64, backpressure=BACKPRESSURE_BLOCK, processes=False,
+                 observe=None):
+        if backpressure not in (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_OLDEST, BACKPRESSURE_PAUSE_ACKS):
+            raise ValueError(f'Unknown backpressure policy {backpressure}')
+        self.backpressure = backpressure
+        self._handler = handler
+        self._observe = observe
+        self._queue_size = queue_size
+        self._queue = deque()
+        self._condition = Condition()
+        self._executor = ProcessPoolExecutor(workers) if processes else None
+        self._is_closed = False
+        self._handled = 0
+        self._dropped = 0
+        self._failures = 0
+        self._handler_seconds = 0.0
+        self._queue_seconds = 0.0
+        self._threads = [Thread(target=self._work_loop, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def is_full(self):
+        return len(self._queue) >= self._queue_size
+
+    def submit(self, data, acknowledged=True):
+        with self._condition:
+            if self._is_closed:
+                self._dropped += 1
+                _logger.warning('Package dropped, the handler pool is closed')
+                return
+            if self.is_full() and self.backpressure == BACKPRESSURE_PAUSE_ACKS and not acknowledged:
+                self._dropped += 1
+                return
+            if self.is_full() and self.backpressure == BACKPRESSURE_DROP_OLDEST:
+                self._queue.popleft()
+                self._dropped += 1
+            while self.is_full() and self.backpressure == BACKPRESSURE_BLOCK and not self._is_closed:
+                self._condition.wait()
+            self._queue.append((data, time.time()))
+            self._condition.notify_all()
+
+    def close(self, timeout=None):
+        # Queued packages were already acknowledged, the workers handle them before stopping. The ones still queued
+        # after timeout seconds (None waits without limit) are dropped.
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify_all()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            if thread is not current_thread():
+                thread.join(None if deadline is None else max(deadline - time.time(), 0))
+        with self._condition:
+            dropped = len(self._queue)
+            self._queue.clear()
+            self._dropped += dropped
+        if dropped:
+            _logger.warning('%s queued packages dropped, the handlers did not finish in %ss', dropped, timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'handler_queue_depth': len(self._queue),
+            'handler_calls': self._handled,
+            'handler_failures': self._failures,
+            'handler_dropped': self._dropped,
+            # Totals, so that they can be added up across workers. Divide by handler_calls for the mean latency.
+            'handler_seconds': self._handler_seconds,
+            'handler_queue_seconds': self._queue_seconds,
+        }
+
+    def _work_loop(self):
+        while 1:
+            with self._condition:
+                while not self._queue and not self._is_closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                data, queued_at = self._queue.popleft()
+                self._condition.notify_all()
+
+            started = time.time()
+            try:
+                if self._executor is not None:
+                    self._executor.submit(self._handler, data).result()
+                else:
+                    self._handler(data)
+            except Exception as e:
+                _logger.exception('Handler failed: %r', e)
+                self._failures += 1
+            finished = time.time()
+            with self._condition:
+                self._handled += 1
+                self._queue_seconds += started - queued_at
+                self._handler_seconds += finished - started
+            if self._observe is not None:
+                self._observe(finished - started)
@@ -0,0 +1,84 @@
+import logging
+import time
+from bisect import bisect_left
+
+
+# Instrumentation shared by Server and Client: histograms that are cheap to update from the receive and send
+# paths, and hooks called on package level events. Counters are plain attributes of the owners, see their stats().
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 1024)
+
+_logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    __slots__ = ('bounds', 'buckets', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The last bucket counts the values above every bound
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': dict(zip(self.bounds + (float('inf'),), self.buckets)),
+        }
+
+
+def merge_snapshots(first, second):
+    # Adds up two Histogram snapshots, for stats gathered from several processes
+    return {
+        'count': first['count'] + second['count'],
+        'sum': first['sum'] + second['sum'],
+        'max': max(first['max'], second['max']),
+        'buckets': {bound: count + second['buckets'].get(bound, 0) for bound, count in first['buckets'].items()},
+    }
+
+
+class Metrics:
+    def __init__(self, histograms):
+        # histograms: name -> bucket bounds
+        self.histograms = {name: Histogram(bounds) for name, bounds in histograms.items()}
+        self.started = time.time()
+        self._hooks = []
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def add_hook(self, hook):
+        # hook(event, info) is called from the thread that produced the event, it has to be quick. Its exceptions
+        # are logged, they never reach that thread.
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def emit(self, event, **info):
+        for hook in self._hooks:
+            try:
+                hook(event, info)
+            except Exception as e:
+                _logger.exception('Hook failed on %s: %r', event, e)
+
+    def rate(self, value):
+        # value per second since the owner was created
+        elapsed = time.time() - self.started
+        return value / elapsed if elapsed > 0 else 0.0
+
+    def snapshot(self):
+        return {name: histogram.snapshot() for name, histogram in self.histograms.items()}
@@ -1,85 +1,774 @@
-from socket import socket, AF_INET, SOCK_DGRAM
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, IPPROTO_IP, SHUT_RDWR
+import socket as _socket
 from hashlib import sha256
+from array import array
+from collections import OrderedDict
+from struct import Struct
+from threading import Thread, Lock, Condition, Event, local, current_thread
+from functools import partial
+from itertools import chain, islice
+import errno
+import io
 import json
+import logging
+import heapq
+import math
+import mmap
+import sys
 import time
-from threading import Thread, Lock
+import zlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from TapNet.datagramIO import DatagramIO
+from TapNet.handlerPool import HandlerPool, BACKPRESSURE_BLOCK, BACKPRESSURE_PAUSE_ACKS
+from TapNet.metrics import Metrics, LATENCY_BUCKETS, COUNT_BUCKETS
+
+# Silent unless the application configures logging, per datagram messages are DEBUG
+_logger = logging.getLogger(__name__)
+
+
+# datagram_type, options, chunk_size, package_id, hash, number_of_subpackages, subpackage_id
+# The type used to be a 4 bytes integer: old peers send options and chunk_size 0, and ignore datagrams where they
+# are not. chunk_size 0 means the original 2048 bytes.
+_HEADER = Struct('<B B H I 32s I I')
+_DEFAULT_CHUNK_SIZE = 2048
+# Largest UDP payload over IPv4 minus our header
+_MAX_CHUNK_SIZE = 65507 - _HEADER.size
+
+# ACK: type (4 bytes), package_id, subpackage_id
+_ACK_SIZE = 12
+
+# Path MTU probes: type, 3 padding bytes, probe_id, padding up to the probed size. Replies: type, probe_id, size
+_PROBE = Struct('<B 3x I')
+_PROBE_REPLY = Struct('<B 3x I I')
+
+# Selective ACK: type, package_id, cumulative, followed by a bitmap. Every chunk below cumulative is acknowledged,
+# bit i of the bitmap (least significant bit first) acknowledges chunk cumulative + 1 + i.
+_SACK = Struct('<B 3x I I')
+_SACK_MAX_BITMAP = 1024
+
+# Negative ACK: type, package_id, number of ids, followed by the ids (4 bytes 'little') of the chunks found missing
+_NACK = Struct('<B 3x I I')
+_NACK_MAX_IDS = 256
+
+
+def _sack_bitmap(received, contiguous, highest):
+    start = contiguous + 1
+    end = min(highest + 1, start + _SACK_MAX_BITMAP * 8)
+    bitmap = bytearray(max(end - start + 7, 0) // 8)
+    for subpackage_id in range(start, end):
+        if received[subpackage_id]:
+            bit = subpackage_id - start
+            bitmap[bit >> 3] |= 1 << (bit & 7)
+    return bitmap
+
+
+def _sack_subpackages(cumulative, bitmap, first_unacked):
+    # Subpackage ids acknowledged by a selective ACK, skipping the ones below first_unacked
+    yield from range(first_unacked, cumulative)
+    for position, byte in enumerate(bitmap):
+        while byte:
+            low_bit = byte & -byte
+            yield cumulative + 1 + position * 8 + low_bit.bit_length() - 1
+            byte ^= low_bit
+
+# Integrity modes, stored in the low bits of the options byte.
+# SHA256: sha256 of every chunk in the hash field, the original format.
+# CRC32 / XXHASH: 8 bytes checksum per chunk, the last chunk also carries the first 24 bytes of the sha256 of the
+# whole package, checked after reassembly. NONE: no checks at all, for trusted links.
+INTEGRITY_SHA256 = 0
+INTEGRITY_CRC32 = 1
+INTEGRITY_XXHASH = 2
+INTEGRITY_NONE = 3
+_INTEGRITY_MASK = 0x07
+# The client understands selective ACKs, the server answers with _SACK datagrams instead of one ACK per chunk
+_OPTION_SACK = 0x08
+_PACKAGE_DIGEST_SIZE = 24
+
+# Compression of the whole package, stored in bits 4-5 of the options byte. Chunks, checksums and digests are the
+# ones of the compressed package, the server decompresses it after reassembly.
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZ4 = 2
+_COMPRESSION_SHIFT = 4
+_COMPRESSION_MASK = 0x30
+_ZLIB_LEVEL = 6
+# Sources are fed to the compressor in pieces of this size, the first _COMPRESSION_SAMPLE bytes tell whether the
+# package is worth compressing
+_COMPRESSION_PIECE = 1024 * 1024
+_COMPRESSION_SAMPLE = 64 * 1024
+_COMPRESSION_MIN_RATIO = 0.9
+
+# The package is a batch of small messages, each one preceded by its length (4 bytes 'little'). It is reassembled,
+# checked and decompressed like any other package and then split into its messages.
+_OPTION_BATCH = 0x40
+_BATCH_LENGTH = Struct('<I')
+_DEFAULT_BATCH_LINGER = 0.002
+
+
+def _shutdown_socket(sock):
+    # A thread blocked reading the socket keeps it (and its port) alive after close(), shutdown wakes it up first.
+    # Unconnected UDP sockets report ENOTCONN but are shut down anyway.
+    try:
+        sock.shutdown(SHUT_RDWR)
+    except OSError as e:
+        if e.errno != errno.ENOTCONN:
+            raise
+    sock.close()
+
+
+def _chunk_checksum(integrity, payload):
+    if integrity == INTEGRITY_CRC32:
+        return zlib.crc32(payload).to_bytes(8, 'little')
+    return xxhash.xxh64_digest(payload)
+
+
+def _compress(compression, pieces, level=_ZLIB_LEVEL):
+    output = bytearray()
+    if compression == COMPRESSION_ZLIB:
+        compressor = zlib.compressobj(level)
+    else:
+        compressor = lz4.frame.LZ4FrameCompressor()
+        output += compressor.begin()
+    for piece in pieces:
+        output += compressor.compress(piece)
+    output += compressor.flush()
+    return output
+
+
+def _unpack_batch(data):
+    messages = []
+    offset = 0
+    while offset < len(data):
+        if offset + _BATCH_LENGTH.size > len(data):
+            raise ValueError('Truncated batch message length')
+        length, = _BATCH_LENGTH.unpack_from(data, offset)
+        offset += _BATCH_LENGTH.size
+        if offset + length > len(data):
+            raise ValueError('Batch message over the end of the package')
+        messages.append(data[offset:offset + length])
+        offset += length
+    return messages
+
+
+def _decompressor(compression):
+    # Both decompress(data, max_length) and eof are shared by the zlib and lz4 decompressors
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompressobj()
+    return lz4.frame.LZ4FrameDecompressor()
+
+
+class _PackageBuffer:
+    # Chunks are written by offset into one preallocated buffer, no join is needed when the package completes.
+    __slots__ = ('chunk_size', 'data', 'received', 'remaining_subpackages', 'contiguous', 'highest', 'size', 'length',
+                 'created', 'last_activity', 'digest', 'compression', 'batch', 'reliable')
+
+    def __init__(self, number_of_subpackages, chunk_size):
+        self.chunk_size = chunk_size
+        self.data = bytearray(number_of_subpackages * chunk_size)
+        # One byte per chunk, 1 once it has arrived
+        self.received = bytearray(number_of_subpackages)
+        self.remaining_subpackages = number_of_subpackages
+        # Every chunk below contiguous has arrived, highest is the largest id received
+        self.contiguous = 0
+        self.highest = -1
+        # Memory taken, counted against max_buffer_memory
+        self.size = len(self.data) + number_of_subpackages
+        self.length = len(self.data)
+        self.created = self.last_activity = time.time()
+        # Package sha256 sent with the last chunk in the fast integrity modes
+        self.digest = None
+        self.compression = COMPRESSION_NONE
+        self.batch = False
+        # Chunks of reliable packages were acknowledged, the package is never evicted to make room for another one
+        self.reliable = False
+
+    def write(self, subpackage_id, payload):
+        offset = subpackage_id * self.chunk_size
+        memoryview(self.data)[offset:offset + len(payload)] = payload
+        if subpackage_id == len(self.received) - 1:
+            # Only the last chunk can be shorter, it tells the real length of the package
+            self.length = offset + len(payload)
+        self.received[subpackage_id] = 1
+        self.remaining_subpackages -= 1
+        self.highest = max(self.highest, subpackage_id)
+        while self.contiguous < len(self.received) and self.received[self.contiguous]:
+            self.contiguous += 1
+
+    def take(self):
+        # Trimming the tail of a bytearray does not copy it
+        del self.data[self.length:]
+        return self.data
+
+
+class _StreamBuffer:
+    # Streaming packages only keep the chunks that arrived out of order, in order chunks are handed over directly.
+    __slots__ = ('chunk_size', 'received', 'remaining_subpackages', 'next_subpackage', 'highest', 'pending', 'size',
+                 'created', 'last_activity', 'digest', 'compression', 'decompressor', 'output_offset', 'batch',
+                 'reliable')
+
+    def __init__(self, number_of_subpackages, chunk_size):
+        self.chunk_size = chunk_size
+        self.received = bytearray(number_of_subpackages)
+        self.remaining_subpackages = number_of_subpackages
+        self.next_subpackage = 0
+        self.highest = -1
+        self.pending = {}
+        # The received bitmap is all a stream takes until chunks arrive out of order
+        self.size = number_of_subpackages
+        self.created = self.last_activity = time.time()
+        self.digest = None
+        self.compression = COMPRESSION_NONE
+        self.batch = False
+        self.reliable = False
+        # Compressed streams are decompressed range by range, offsets are then the ones of the decompressed data
+        self.decompressor = None
+        self.output_offset = 0
+
+    def write(self, subpackage_id, payload):
+        # Returns the (offset, data) ranges that became contiguous with this chunk
+        self.received[subpackage_id] = 1
+        self.remaining_subpackages -= 1
+        self.highest = max(self.highest, subpackage_id)
+        if subpackage_id != self.next_subpackage:
+            self.pending[subpackage_id] = bytes(payload)
+            self.size += len(payload)
+            return []
+
+        ready = [(subpackage_id * self.chunk_size, payload)]
+        self.next_subpackage += 1
+        while self.next_subpackage in self.pending:
+            payload = self.pending.pop(self.next_subpackage)
+            self.size -= len(payload)
+            ready.append((self.next_subpackage * self.chunk_size, payload))
+            self.next_subpackage += 1
+        return ready
+
+    @property
+    def contiguous(self):
+        return self.next_subpackage
+
+
+class _ReassemblyStore:
+    # Partial packages ordered from least to most recently active, so both eviction and expiration pop from the front
+    _COMPLETED_MEMORY = 4096
+
+    def __init__(self, max_memory, package_timeout, on_discard=None):
+        self._on_discard = on_discard
+        self._max_memory = max_memory
+        self._package_timeout = package_timeout
+        self._packages = OrderedDict()
+        # Recently completed packages, late retransmissions of them are acknowledged but not stored again
+        self._completed = OrderedDict()
+        # Recently evicted or expired packages, their late chunks are neither stored nor acknowledged
+        self._discarded = OrderedDict()
+        self.memory_used = 0
+        self.evicted_packages = 0
+        self.expired_packages = 0
+
+    def __contains__(self, unique_identifier):
+        return unique_identifier in self._packages
+
+    def __len__(self):
+        return len(self._packages)
+
+    def get(self, unique_identifier):
+        package = self._packages.get(unique_identifier)
+        if package is not None:
+            package.last_activity = time.time()
+            self._packages.move_to_end(unique_identifier)
+        return package
+
+    def create(self, unique_identifier, number_of_subpackages, chunk_size, streaming=False, reliable=False):
+        # Returns None when the package does not fit, reliable packages are then refused until memory is released
+        # The header is not trusted: nothing is allocated before the size is checked. A stream only keeps its
+        # bitmap, the length of a package handed over as it arrives is bounded by the bitmap it needs.
+        size = number_of_subpackages if streaming else number_of_subpackages * (chunk_size + 1)
+        if size > self._max_memory:
+            return None
+        if not self._make_room(size):
+            return None
+        if streaming:
+            package = _StreamBuffer(number_of_subpackages, chunk_size)
+        else:
+            package = _PackageBuffer(number_of_subpackages, chunk_size)
+        package.reliable = reliable
+        self._packages[unique_identifier] = package
+        self.memory_used += package.size
+        return package
+
+    def write(self, package, subpackage_id, payload):
+        # Returns the ready ranges of a stream (empty for a buffered package), None if the chunk was not stored
+        if isinstance(package, _StreamBuffer) and subpackage_id != package.next_subpackage and \
+                not self._make_room(len(payload), keep=package):
+            # Out of order chunks are kept until the gap is filled, there is no memory left for this one
+            return None
+        size = package.size
+        ready = package.write(subpackage_id, payload)
+        self.memory_used += package.size - size
+        return ready or ()
+
+    def _make_room(self, size, keep=None):
+        # Evicts the least recently active packages that are not reliable, returns False if size still does not fit
+        if self.memory_used + size <= self._max_memory:
+            return True
+        for evicted_identifier, evicted in list(self._packages.items()):
+            if evicted is keep or evicted.reliable:
+                continue
+            self._discard(evicted_identifier)
+            self.evicted_packages += 1
+            _logger.warning('Package %s evicted, reassembly memory full', evicted_identifier)
+            if self.memory_used + size <= self._max_memory:
+                return True
+        return False
+
+    def discard(self, unique_identifier):
+        # Packages that can't complete anymore (a corrupt compressed stream)
+        self._discard(unique_identifier)
+
+    def _discard(self, unique_identifier):
+        package = self._packages.pop(unique_identifier)
+        self.memory_used -= package.size
+        self._discarded[unique_identifier] = time.time()
+        if len(self._discarded) > self._COMPLETED_MEMORY:
+            self._discarded.popitem(last=False)
+        if self._on_discard is not None:
+            self._on_discard(unique_identifier, package)
+
+    def pop(self, unique_identifier):
+        package = self._packages.pop(unique_identifier)
+        self.memory_used -= package.size
+        self._completed[unique_identifier] = time.time()
+        if len(self._completed) > self._COMPLETED_MEMORY:
+            self._completed.popitem(last=False)
+        return package
+
+    def is_completed(self, unique_identifier):
+        return unique_identifier in self._completed
+
+    def is_discarded(self, unique_identifier):
+        return unique_identifier in self._discarded
+
+    def expire(self, now):
+        while self._packages:
+            unique_identifier, package = next(iter(self._packages.items()))
+            if now - package.last_activity < self._package_timeout:
+                break
+            self._discard(unique_identifier)
+            self.expired_packages += 1
+            _logger.warning('Package %s expired after %ss without data', unique_identifier, self._package_timeout)
+        for finished in (self._completed, self._discarded):
+            while finished:
+                unique_identifier, finish_time = next(iter(finished.items()))
+                if now - finish_time < self._package_timeout:
+                    break
+                del finished[unique_identifier]
 
 
 class Server:
     _DATAGRAM_ACK = 0
     _DATAGRAM_NORMAL = 1
     _DATAGRAM_RELIABLE = 2
+    _DATAGRAM_PROBE = 3
+    _DATAGRAM_PROBE_REPLY = 4
+    _DATAGRAM_SACK = 5
+    _DATAGRAM_NACK = 6
+
+    # Selective ACKs go out every _SACK_EVERY chunks of a package, the rest once the received batch is handled
+    _SACK_EVERY = 16
 
-    _CHUNK_SIZE = 2048
+    _MAX_BUFFER_MEMORY = 64 * 1024 * 1024
+    _PACKAGE_TIMEOUT = 30
 
-    def __init__(self, address=None, port=None, handler=None):
+    # handler(data) is called once per completed package. stream_handler(unique_identifier, offset, data, completed)
+    # is called instead with every contiguous range of a package as soon as it is available, data is only valid
+    # during the call. A package discarded before completion (expired, evicted or corrupt) gets a last call with
+    # data None and completed True, offset is then the number of bytes already handed over.
+    # reuse_port lets several servers (one per process) bind the same port, see ServerPool.
+    # max_chunk_size is the largest chunk accepted from clients, the receive buffers are sized after it.
+    # With handler_workers > 0 handler runs in a HandlerPool of that many threads (processes with handler_processes,
+    # not available inside a ServerPool) fed by a queue of handler_queue_size packages, see handlerPool for the
+    # backpressure policies.
+    # Batches of small messages (see Client batch_size) call handler once per message, or once per batch with the
+    # list of messages when deliver_batches is set. A streaming server gets every message as a package of its own,
+    # identified by the batch unique_identifier plus the message index.
+    # sock is a socket shared with a Client (see rpc), the server is then not started: its owner binds the socket
+    # and passes the data datagrams it receives to _handle_datagram.
+    def __init__(self, address=None, port=None, handler=None, max_buffer_memory=_MAX_BUFFER_MEMORY,
+                 package_timeout=_PACKAGE_TIMEOUT, stream_handler=None, reuse_port=False,
+                 max_chunk_size=_MAX_CHUNK_SIZE, handler_workers=0, handler_queue_size=64,
+                 backpressure=BACKPRESSURE_BLOCK, handler_processes=False, deliver_batches=False, sock=None):
         self.address = address
         self.port = port
-        self._socket = socket(AF_INET, SOCK_DGRAM)
+        self._reuse_port = reuse_port
+        self._max_chunk_size = max_chunk_size
+        self._socket = sock if sock is not None else self._create_socket()
         self._response_handler = handler
-        self._packages = {}
+        self._stream_handler = stream_handler
+        self._deliver_batches = deliver_batches
+        self._metrics = Metrics({'package_latency': LATENCY_BUCKETS, 'handler_seconds': LATENCY_BUCKETS})
+        self._handlers = None
+        if handler_workers and handler is not None:
+            self._handlers = HandlerPool(handler, handler_workers, handler_queue_size, backpressure,
+                                         processes=handler_processes,
+                                         observe=partial(self._metrics.observe, 'handler_seconds'))
+        self._packages = _ReassemblyStore(max_buffer_memory, package_timeout, on_discard=self._discard_package)
+        # Decompressed packages can't be larger than the reassembly memory either
+        self._max_decompressed_size = max_buffer_memory
         self._package_identifier = 0
+        self._io = None
+        # While a received batch is handled, outgoing datagrams (ACKs) are queued here and sent together
+        self._outgoing = None
+        # unique_identifier -> [package, package_id, address, chunks not acknowledged yet]
+        self._pending_acks = {}
+        self._datagrams_received = 0
+        self._datagrams_sent = 0
+        self._datagrams_dropped = 0
+        self._hash_failures = 0
+        self._package_hash_failures = 0
+        self._nacks_sent = 0
+        self._paused_chunks = 0
+        self._decompression_failures = 0
+        self._batch_failures = 0
+        self._batched_messages = 0
+        self._packages_completed = 0
+        self._bytes_delivered = 0
+
+    def stats(self):
+        stats = {
+            'datagrams_received': self._datagrams_received,
+            'datagrams_sent': self._datagrams_sent,
+            'datagrams_dropped': self._datagrams_dropped,
+            'hash_failures': self._hash_failures,
+            'package_hash_failures': self._package_hash_failures,
+            'nacks_sent': self._nacks_sent,
+            'paused_chunks': self._paused_chunks,
+            'decompression_failures': self._decompression_failures,
+            'batch_failures': self._batch_failures,
+            'batched_messages': self._batched_messages,
+            'packages_completed': self._packages_completed,
+            'bytes_delivered': self._bytes_delivered,
+            'bytes_per_second': self._metrics.rate(self._bytes_delivered),
+            'partial_packages': len(self._packages),
+            'reassembly_memory': self._packages.memory_used,
+            'evicted_packages': self._packages.evicted_packages,
+            'expired_packages': self._packages.expired_packages,
+        }
+        if self._handlers is not None:
+            stats.update(self._handlers.stats())
+        stats['histograms'] = self._metrics.snapshot()
+        return stats
+
+    # hook(event, info) is called on 'package_completed', 'package_discarded' and 'hash_failure'
+    def add_hook(self, hook):
+        self._metrics.add_hook(hook)
+
+    def remove_hook(self, hook):
+        self._metrics.remove_hook(hook)
 
     def start(self):
         self._bound_server()
+        self._io = DatagramIO(self._socket, buffer_size=self._max_chunk_size + _HEADER.size)
         self._listen_loop()
 
-    def end(self):
+    def end(self, timeout=None):
+        # Packages already handed to the handler pool get timeout seconds to be handled
         self._socket.close()
-        print(f'Connection closed.')
+        if self._handlers is not None:
+            self._handlers.close(timeout)
+        _logger.info('Connection closed.')
+
+    def _create_socket(self):
+        return socket(AF_INET, SOCK_DGRAM)
+
+    def _sendto(self, data, address):
+        self._datagrams_sent += 1
+        if self._outgoing is not None:
+            self._outgoing.append(((data,), address))
+        else:
+            self._socket.sendto(data, address)
 
     def _bound_server(self):
+        if self._reuse_port:
+            if not hasattr(_socket, 'SO_REUSEPORT'):
+                raise OSError('SO_REUSEPORT is not available on this platform')
+            self._socket.setsockopt(SOL_SOCKET, _socket.SO_REUSEPORT, 1)
         self._socket.bind((self.address, self.port))
-        print(f'Server bound on port {self.port}, host {self.address}')
+        _logger.info('Server bound on port %s, host %s', self.port, self.address)
 
     def _send_ack(self, package_id, subpackage_id, address):
         ack = self._DATAGRAM_ACK.to_bytes(4, 'little') + package_id.to_bytes(4, 'little') + \
               subpackage_id.to_bytes(4, 'little')
-        print(f"ACK sended to {package_id}, {subpackage_id}")
-        self._socket.sendto(ack, address)
+        _logger.debug('ACK sent to %s, %s', package_id, subpackage_id)
+        self._sendto(ack, address)
+
+    def _send_nack(self, package_id, subpackage_ids, address):
+        subpackage_ids = subpackage_ids[:_NACK_MAX_IDS]
+        _logger.debug('NACK sent to %s, %s missing', package_id, len(subpackage_ids))
+        self._nacks_sent += 1
+        self._sendto(_NACK.pack(self._DATAGRAM_NACK, package_id, len(subpackage_ids)) +
+                     b''.join(subpackage_id.to_bytes(4, 'little') for subpackage_id in subpackage_ids), address)
+
+    def _send_sack(self, package_id, cumulative, bitmap, address):
+        self._sendto(_SACK.pack(self._DATAGRAM_SACK, package_id, cumulative) + bitmap, address)
 
-    def _create_package_register(self, unique_identifier, number_of_subpackages):
-        self._packages[unique_identifier] = {}
-        self._packages[unique_identifier]['data'] = [False for _ in range(number_of_subpackages)]
-        self._packages[unique_identifier]['remaining_subpackages'] = number_of_subpackages
+    def _queue_ack(self, unique_identifier, package, package_id, address):
+        pending = self._pending_acks.get(unique_identifier)
+        if pending is None:
+            pending = self._pending_acks[unique_identifier] = [package, package_id, address, 0]
+            self._schedule_ack_flush()
+        pending[3] += 1
+        if pending[3] >= self._SACK_EVERY or package.remaining_subpackages == 0:
+            self._flush_ack(unique_identifier)
 
-    def _check_if_package_already_registered(self, unique_identifier, number_of_subpackages):
-        if unique_identifier not in self._packages.keys():
-            self._create_package_register(unique_identifier, number_of_subpackages)
+    def _flush_ack(self, unique_identifier):
+        package, package_id, address, _ = self._pending_acks.pop(unique_identifier)
+        _logger.debug('SACK sent to %s, up to %s', package_id, package.contiguous)
+        self._send_sack(package_id, package.contiguous,
+                        _sack_bitmap(package.received, package.contiguous, package.highest), address)
 
-    def _save_package_payload(self, unique_identifier, package_id, subpackage_id, payload, address, reliable):
-        if reliable:
+    def _flush_acks(self):
+        for unique_identifier in list(self._pending_acks):
+            self._flush_ack(unique_identifier)
+
+    def _schedule_ack_flush(self):
+        # The listen loop flushes after every received batch
+        pass
+
+    def _create_package_register(self, unique_identifier, number_of_subpackages, chunk_size, compression, batch,
+                                 reliable=False):
+        # Batches are split into messages once complete, they are never streamed
+        streaming = self._stream_handler is not None and not batch
+        package = self._packages.create(unique_identifier, number_of_subpackages, chunk_size, streaming=streaming,
+                                        reliable=reliable)
+        if package is not None:
+            package.batch = batch
+        if package is not None and compression != COMPRESSION_NONE:
+            package.compression = compression
+            if streaming:
+                package.decompressor = _decompressor(compression)
+        return package
+
+    def _check_if_package_already_registered(self, unique_identifier, number_of_subpackages, chunk_size,
+                                             compression=COMPRESSION_NONE, batch=False, reliable=False):
+        package = self._packages.get(unique_identifier)
+        if package is None:
+            package = self._create_package_register(unique_identifier, number_of_subpackages, chunk_size, compression,
+                                                    batch, reliable)
+        elif package.chunk_size != chunk_size or len(package.received) != number_of_subpackages or \
+                package.compression != compression or package.batch != batch:
+            # Not a chunk of this package (corrupt header or reused id), offsets would not match
+            return None
+        return package
+
+    def _save_package_payload(self, unique_identifier, package, package_id, subpackage_id, payload, address,
+                              reliable, sack=False):
+        # Chunks of a package that could not be buffered are not acknowledged, the client will send them again
+        if package is None:
+            self._datagrams_dropped += 1
+            return
+        # Retransmissions of chunks whose ACK got lost are not stored twice
+        if not package.received[subpackage_id]:
+            if reliable and subpackage_id > package.highest + 1:
+                # Chunks are sent in order, the ones skipped over were lost (or reordered), ask for them right away
+                self._send_nack(package_id, range(package.highest + 1, subpackage_id), address)
+            _logger.debug('Saving payload from packageid:%s, subpackageid:%s', package_id, subpackage_id)
+            ready = self._packages.write(package, subpackage_id, payload)
+            if ready is None:
+                self._datagrams_dropped += 1
+                return
+            if reliable and not sack:
+                self._send_ack(package_id, subpackage_id, address)
+            if self._stream_handler is not None and not package.batch:
+                for offset, data in ready:
+                    completed = package.next_subpackage == len(package.received) and offset == ready[-1][0]
+                    if package.decompressor is not None:
+                        offset, data = package.output_offset, self._decompress(package, data, package.output_offset)
+                        if data is not None and completed and not package.decompressor.eof:
+                            self._decompression_failures += 1
+                            _logger.warning('Package %s ended before its compressed stream', unique_identifier)
+                            data = None
+                        if data is None:
+                            # Part of the package was already handed over, the handler learns from the discard.
+                            # Its later chunks are neither stored nor acknowledged.
+                            self._packages.discard(unique_identifier)
+                            return
+                        package.output_offset += len(data)
+                    self._bytes_delivered += len(data)
+                    self._deliver_range(unique_identifier, offset, data, completed)
+        elif reliable and not sack:
             self._send_ack(package_id, subpackage_id, address)
-        # We do this so we can avoid residual data with lates ACK
-        if self._packages[unique_identifier]['remaining_subpackages'] != 0:
-            print(f"Saving payload from {unique_identifier}, packageid:{package_id}, subpackageid{subpackage_id}")
-            self._packages[unique_identifier]['data'][subpackage_id] = payload
-            self._packages[unique_identifier]['remaining_subpackages'] -= 1
+        if reliable and sack:
+            self._queue_ack(unique_identifier, package, package_id, address)
 
     def _parse_content(self, datagram):
-        package_id = int.from_bytes(datagram[4:8], 'little')
-        number_of_subpackages = int.from_bytes(datagram[40:44], 'little')
-        subpackage_id = int.from_bytes(datagram[44:48], 'little')
-        payload = datagram[48:]
+        _, _, chunk_size, package_id, _, number_of_subpackages, subpackage_id = _HEADER.unpack_from(datagram)
+        payload = memoryview(datagram)[_HEADER.size:]
+
+        return package_id, number_of_subpackages, subpackage_id, chunk_size or _DEFAULT_CHUNK_SIZE, payload
 
-        return package_id, number_of_subpackages, subpackage_id, payload
+    # decompressor: the one of a streaming package, None decompresses data as a whole package. Returns None (and
+    # counts the failure) when data is corrupt or the output would exceed the reassembly memory.
+    def _decompress(self, package, data, output_offset=0, decompressor=None):
+        decompressor = decompressor or package.decompressor or _decompressor(package.compression)
+        limit = self._max_decompressed_size - output_offset
+        try:
+            output = decompressor.decompress(data, limit + 1)
+        except (zlib.error, RuntimeError) as e:
+            output = None
+            _logger.warning('Package could not be decompressed: %s', e)
+        if output is not None and len(output) > limit:
+            output = None
+            _logger.warning('Package discarded, decompressed size over %s bytes', self._max_decompressed_size)
+        if output is None:
+            self._decompression_failures += 1
+        return output
 
     def _if_package_completed_handle_and_clean(self, unique_identifier):
-        if self._packages[unique_identifier]['remaining_subpackages'] == 0:
-            print(f"Package id {unique_identifier} completed!")
-            self._response_handler(b''.join((subdata for subdata in self._packages[unique_identifier]['data'])))
-            del self._packages[unique_identifier]['data'][:]
+        package = self._packages.get(unique_identifier)
+        if package is not None and package.remaining_subpackages == 0:
+            _logger.debug('Package id %s completed', unique_identifier)
+            package = self._packages.pop(unique_identifier)
+            self._packages_completed += 1
+            latency = time.time() - package.created
+            self._metrics.observe('package_latency', latency)
+            if self._stream_handler is None or package.batch:
+                data = package.take()
+                if package.digest is not None and sha256(data).digest()[:_PACKAGE_DIGEST_SIZE] != package.digest:
+                    # Chunks were already acknowledged, the package is lost
+                    _logger.warning('Package id %s discarded, package hash does not match', unique_identifier)
+                    self._package_hash_failures += 1
+                    self._metrics.emit('package_discarded', unique_identifier=unique_identifier,
+                                       reason='package_hash')
+                    return
+                if package.compression != COMPRESSION_NONE:
+                    decompressor = _decompressor(package.compression)
+                    data = self._decompress(package, data, decompressor=decompressor)
+                    if data is None or not decompressor.eof:
+                        self._metrics.emit('package_discarded', unique_identifier=unique_identifier,
+                                           reason='decompression')
+                        return
+                self._bytes_delivered += len(data)
+                self._metrics.emit('package_completed', unique_identifier=unique_identifier, size=len(data),
+                                   latency=latency)
+                if package.batch:
+                    self._deliver_batch(unique_identifier, data, package.reliable)
+                else:
+                    self._deliver(data, unique_identifier, package.reliable)
+            else:
+                self._metrics.emit('package_completed', unique_identifier=unique_identifier, size=None,
+                                   latency=latency)
+
+    def _deliver(self, data, unique_identifier=None, reliable=True):
+        if self._handlers is not None:
+            self._handlers.submit(data, acknowledged=reliable)
+        else:
+            started = time.time()
+            self._response_handler(data)
+            self._metrics.observe('handler_seconds', time.time() - started)
+
+    def _deliver_batch(self, unique_identifier, data, reliable=True):
+        try:
+            messages = _unpack_batch(data)
+        except ValueError as e:
+            _logger.warning('Batch %s discarded: %s', unique_identifier, e)
+            self._batch_failures += 1
+            self._metrics.emit('package_discarded', unique_identifier=unique_identifier, reason='batch')
+            return
+        self._batched_messages += len(messages)
+        if self._stream_handler is not None:
+            for index, message in enumerate(messages):
+                self._deliver_range(unique_identifier + (index,), 0, message, True)
+        elif self._deliver_batches:
+            self._deliver(messages, unique_identifier, reliable)
+        else:
+            for message in messages:
+                self._deliver(message, unique_identifier, reliable)
+
+    def _acks_paused(self):
+        return self._handlers is not None and self._handlers.backpressure == BACKPRESSURE_PAUSE_ACKS and \
+            self._handlers.is_full()
+
+    def _extends_package(self, unique_identifier, subpackage_id):
+        # The missing chunk that later chunks already buffered wait for is taken even while paused, otherwise they
+        # could hold the memory until the client gives up on it
+        package = self._packages.get(unique_identifier)
+        return package is not None and package.contiguous == subpackage_id < package.highest
+
+    def _deliver_range(self, unique_identifier, offset, data, completed):
+        self._stream_handler(unique_identifier, offset, data, completed)
+
+    def _discard_range(self, unique_identifier, offset):
+        self._stream_handler(unique_identifier, offset, None, True)
+
+    def _discard_package(self, unique_identifier, package):
+        # Expired, evicted or corrupt before completion, streaming handlers have already received part of it
+        self._pending_acks.pop(unique_identifier, None)
+        self._metrics.emit('package_discarded', unique_identifier=unique_identifier, reason='incomplete')
+        if self._stream_handler is not None and isinstance(package, _StreamBuffer):
+            offset = package.output_offset if package.decompressor is not None else \
+                package.contiguous * package.chunk_size
+            self._discard_range(unique_identifier, offset)
 
     def _parse_datagram(self, datagram, address, reliable=False):
         # Datagram Header: datagram_type, packet_id, hash, number_of_subpackages, subpackage_id
-        if self._hash_is_correct(datagram):
-            package_id, number_of_subpackages, subpackage_id, payload = self._parse_content(datagram)
-            if subpackage_id != 80:
-                print(f"Received datagram from {address}, packageid:{package_id}, subpackageid{subpackage_id}")
-                unique_identifier = self._create_unique_identifier(address, package_id)
-                self._check_if_package_already_registered(unique_identifier, number_of_subpackages)
-                self._save_package_payload(unique_identifier, package_id, subpackage_id, payload, address, reliable)
-                self._if_package_completed_handle_and_clean(unique_identifier)
+        if not self._hash_is_correct(datagram):
+            self._hash_failures += 1
+            self._datagrams_dropped += 1
+            self._metrics.emit('hash_failure', address=address)
+        else:
+            package_id, number_of_subpackages, subpackage_id, chunk_size, payload = self._parse_content(datagram)
+            if subpackage_id >= number_of_subpackages or len(payload) > chunk_size or \
+                    chunk_size > self._max_chunk_size:
+                self._datagrams_dropped += 1
+                return
+            _logger.debug('Received datagram from %s, packageid:%s, subpackageid:%s', address, package_id,
+                          subpackage_id)
+            unique_identifier = self._create_unique_identifier(address, package_id)
+            self._packages.expire(time.time())
+            sack = bool(datagram[1] & _OPTION_SACK)
+            if self._packages.is_discarded(unique_identifier):
+                # Chunks already acknowledged were thrown away, the package can not complete anymore
+                self._datagrams_dropped += 1
+                return
+            if self._packages.is_completed(unique_identifier):
+                # Late retransmission, the ACK of the first copy was lost
+                if reliable and sack:
+                    self._send_sack(package_id, number_of_subpackages, b'', address)
+                elif reliable:
+                    self._send_ack(package_id, subpackage_id, address)
+                return
+            if reliable and self._acks_paused() and not self._extends_package(unique_identifier, subpackage_id):
+                # Handlers are behind, the chunk is neither stored nor acknowledged and the client will resend it
+                self._paused_chunks += 1
+                self._datagrams_dropped += 1
+                return
+            compression = (datagram[1] & _COMPRESSION_MASK) >> _COMPRESSION_SHIFT
+            if compression not in (COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_LZ4) or \
+                    compression == COMPRESSION_LZ4 and lz4 is None:
+                _logger.warning('Datagram with unsupported compression %s dropped', compression)
+                self._datagrams_dropped += 1
+                return
+            package = self._check_if_package_already_registered(unique_identifier, number_of_subpackages,
+                                                                chunk_size, compression,
+                                                                bool(datagram[1] & _OPTION_BATCH), reliable)
+            integrity = datagram[1] & _INTEGRITY_MASK
+            if package is not None and subpackage_id == number_of_subpackages - 1 and \
+                    integrity in (INTEGRITY_CRC32, INTEGRITY_XXHASH):
+                # Streaming packages are handed over before they are complete, only chunk checksums apply to them
+                package.digest = bytes(datagram[16:16 + _PACKAGE_DIGEST_SIZE])
+            self._save_package_payload(unique_identifier, package, package_id, subpackage_id, payload, address,
+                                       reliable, sack)
+            self._if_package_completed_handle_and_clean(unique_identifier)
 
     def _create_unique_identifier(self, address, package_id):
         #unique_identifier = (address[0], address[1], self._package_identifier, package_id)
@@ -88,24 +777,46 @@ class Server:
         return unique_identifier
 
     def _get_datagram_type(self, datagram):
-        return int.from_bytes(datagram[:4], 'little')
+        return datagram[0]
 
     def _listen_loop(self):
         while 1:
-            datagram, address = self._socket.recvfrom(4096)
+            self._outgoing = []
+            for datagram, address in self._io.recv_batch():
+                self._handle_datagram(datagram, address)
+            self._flush_acks()
+            outgoing, self._outgoing = self._outgoing, None
+            self._io.send_batch(outgoing)
 
-            datagram_type = self._get_datagram_type(datagram)
+    def _handle_datagram(self, datagram, address):
+        self._datagrams_received += 1
+        # Truncated datagrams are dropped before any field is read
+        datagram_type = self._get_datagram_type(datagram) if datagram else None
 
-            # Todo: crear log.txt con los paquetes recibidos
+        # Todo: crear log.txt con los paquetes recibidos
 
-            if datagram_type == self._DATAGRAM_RELIABLE:
-                self._parse_datagram(datagram, address, reliable=True)
-            elif datagram_type == self._DATAGRAM_NORMAL:
-                self._parse_datagram(datagram, address, reliable=False)
+        if datagram_type == self._DATAGRAM_RELIABLE and len(datagram) >= _HEADER.size:
+            self._parse_datagram(datagram, address, reliable=True)
+        elif datagram_type == self._DATAGRAM_NORMAL and len(datagram) >= _HEADER.size:
+            self._parse_datagram(datagram, address, reliable=False)
+        elif datagram_type == self._DATAGRAM_PROBE and len(datagram) >= _PROBE.size:
+            _, probe_id = _PROBE.unpack_from(datagram)
+            self._sendto(_PROBE_REPLY.pack(self._DATAGRAM_PROBE_REPLY, probe_id, len(datagram)), address)
+        else:
+            self._datagrams_dropped += 1
 
     def _hash_is_correct(self, datagram):
+        integrity = datagram[1] & _INTEGRITY_MASK
+        payload = memoryview(datagram)[_HEADER.size:]
+        if integrity == INTEGRITY_NONE:
+            return True
+        if integrity in (INTEGRITY_CRC32, INTEGRITY_XXHASH):
+            if integrity == INTEGRITY_XXHASH and xxhash is None:
+                _logger.warning('Datagram with xxhash checksum dropped, xxhash is not installed')
+                return False
+            return datagram[8:16] == _chunk_checksum(integrity, payload)
+
         hash_received = datagram[8:40]
-        payload = datagram[48:]
 
         payload_hash = sha256(payload).digest()
 
@@ -115,166 +826,827 @@ class Server:
             return True
 
 
+class _ReliablePackage:
+    # Send state of one reliable package. Per chunk values live in flat arrays, the only per chunk objects are the
+    # chunks kept for retransmission, released as soon as they are acknowledged.
+    __slots__ = ('destination', 'acks', 'remaining_acks', 'acked_until', 'headers', 'chunks', 'remaining_attempts',
+                 'last_send_time', 'started', 'retransmissions', 'given_up')
+
+    def __init__(self, number_of_subpackages, destination, attempts):
+        self.destination = destination
+        self.acks = bytearray(number_of_subpackages)
+        self.remaining_acks = number_of_subpackages
+        # Every chunk below acked_until is acknowledged
+        self.acked_until = 0
+        # Headers are packed here when the chunks are first sent and reused by retransmissions
+        self.headers = bytearray(number_of_subpackages * _HEADER.size)
+        self.chunks = [None] * number_of_subpackages
+        self.remaining_attempts = bytearray([attempts]) * number_of_subpackages
+        self.last_send_time = array('d', bytes(8 * number_of_subpackages))
+        self.started = time.time()
+        self.retransmissions = 0
+        # Chunks that ran out of attempts, the package is then reported as failed
+        self.given_up = 0
+
+    def header(self, subpackage_id):
+        offset = subpackage_id * _HEADER.size
+        return memoryview(self.headers)[offset:offset + _HEADER.size]
+
+    def acknowledge(self, subpackage_id):
+        self.acks[subpackage_id] = 1
+        self.chunks[subpackage_id] = None
+        self.remaining_acks -= 1
+
+
+class _MessageBatch:
+    # Small messages waiting to be sent as one package, already framed with their lengths
+    __slots__ = ('data', 'messages', 'deadline')
+
+    def __init__(self, deadline):
+        self.data = bytearray()
+        self.messages = 0
+        self.deadline = deadline
+
+    def add(self, message):
+        self.data += _BATCH_LENGTH.pack(len(message))
+        self.data += message
+        self.messages += 1
+
+
+class _CongestionWindow:
+    # Window counted in chunks. Slow start until ssthresh, then additive increase; halved on loss.
+    _INITIAL_WINDOW = 4
+    _INITIAL_SSTHRESH = 64
+    _MAX_WINDOW = 1024
+
+    # RTT estimator constants (RFC 6298)
+    _ALPHA = 1 / 8
+    _BETA = 1 / 4
+    _MIN_RTO = 0.2
+    _MAX_RTO = 8
+
+    def __init__(self, initial_rto):
+        self.size = float(self._INITIAL_WINDOW)
+        self.ssthresh = float(self._INITIAL_SSTHRESH)
+        self.in_flight = 0
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self._last_decrease = 0.0
+        self._condition = Condition()
+
+    def acquire_slot(self):
+        self.acquire_slots(1)
+
+    def acquire_slots(self, wanted):
+        # Blocks until the window has room, then takes as many slots as possible up to wanted
+        with self._condition:
+            while self.in_flight >= int(self.size):
+                self._condition.wait(self.rto)
+            granted = min(wanted, int(self.size) - self.in_flight)
+            self.in_flight += granted
+            return granted
+
+    def release_slot(self, count=1):
+        with self._condition:
+            self.in_flight = max(self.in_flight - count, 0)
+            self._condition.notify()
+
+    def on_ack(self, rtt_sample=None):
+        self.on_acks(1, rtt_sample)
+
+    # count chunks acknowledged at once (selective ACK), the window grows as if they had been acknowledged one by one
+    def on_acks(self, count, rtt_sample=None):
+        with self._condition:
+            if rtt_sample is not None:
+                self._update_rto(rtt_sample)
+            for _ in range(count):
+                if self.size < self.ssthresh:
+                    self.size += 1
+                else:
+                    self.size += 1 / self.size
+            self.size = min(self.size, self._MAX_WINDOW)
+            self.in_flight = max(self.in_flight - count, 0)
+            self._condition.notify_all()
+
+    def on_loss(self):
+        # A NACK means later chunks still get through, the window shrinks (by 0.7, as CUBIC does) instead of starting
+        # over from one
+        with self._condition:
+            now = time.time()
+            if now - self._last_decrease > (self.srtt or self.rto):
+                self.ssthresh = max(self.size * 0.7, 2)
+                self.size = self.ssthresh
+                self._last_decrease = now
+
+    def on_timeout(self):
+        with self._condition:
+            now = time.time()
+            # Only react once per round trip, a burst of timeouts is a single congestion event
+            if now - self._last_decrease > (self.srtt or self.rto):
+                self.ssthresh = max(self.in_flight / 2, 2)
+                self.size = 1.0
+                self._last_decrease = now
+
+    def _update_rto(self, rtt_sample):
+        if self.srtt is None:
+            self.srtt = rtt_sample
+            self.rttvar = rtt_sample / 2
+        else:
+            self.rttvar = (1 - self._BETA) * self.rttvar + self._BETA * abs(self.srtt - rtt_sample)
+            self.srtt = (1 - self._ALPHA) * self.srtt + self._ALPHA * rtt_sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self._MIN_RTO), self._MAX_RTO)
+
+
 class Client:
     _DATAGRAM_ACK = 0
     _DATAGRAM_NORMAL = 1
     _DATAGRAM_RELIABLE = 2
+    _DATAGRAM_PROBE = 3
+    _DATAGRAM_PROBE_REPLY = 4
+    _DATAGRAM_SACK = 5
+    _DATAGRAM_NACK = 6
 
-    _CHUNK_SIZE = 2048
+    # Datagram sizes tried when discovering the chunk size: loopback, jumbo frames, ethernet, IPv6 minimum MTU and
+    # IPv4 minimum MTU, all of them minus the IP and UDP headers
+    _PROBE_SIZES = (65507, 8972, 1472, 1252, 548)
+    _PROBE_TIMEOUT = 0.2
+    _PROBE_ATTEMPTS = 3
 
+    # Initial retransmission timeout, until the first RTT samples arrive
     _AWAIT_TIME = 1
     _SEND_ATTEMPTS = 3
 
-    def __init__(self, address=None, address_port=None, local_port=None):
+    # Maximum number of datagrams handed to the kernel in one call
+    _SEND_BATCH = 32
+    # Receive buffers only need to hold control datagrams (ACKs)
+    _RECEIVE_BUFFER_SIZE = 4096
+
+    # With discover_chunk_size the client probes (address, address_port) when its socket is bound, and uses the
+    # largest chunk that reaches it without IP fragmentation instead of chunk_size.
+    # sack asks the server for selective ACKs, one per received batch instead of one per chunk. Servers older than
+    # the options byte read the flag as part of the datagram type and drop everything, so it is off by default.
+    # With compression every package larger than one chunk is compressed, unless its first bytes don't shrink.
+    # With batch_size > 0 messages up to that size (framing included) are not sent right away: the ones for the same
+    # destination and datagram type are packed into one package, sent once the next one doesn't fit or batch_linger
+    # seconds after the first. A batch_size of at most chunk_size keeps every batch in one datagram.
+    # sock is a bound socket shared with a Server (see rpc): the client sends through it but doesn't read it, the
+    # owner passes the control datagrams it receives (ACKs) to _dispatch_datagram.
+    def __init__(self, address=None, address_port=None, local_port=None, integrity=INTEGRITY_SHA256,
+                 chunk_size=_DEFAULT_CHUNK_SIZE, discover_chunk_size=False, sack=False, compression=COMPRESSION_NONE,
+                 batch_size=0, batch_linger=_DEFAULT_BATCH_LINGER, sock=None):
+        if integrity == INTEGRITY_XXHASH and xxhash is None:
+            raise ImportError('INTEGRITY_XXHASH needs the xxhash package')
+        if compression == COMPRESSION_LZ4 and lz4 is None:
+            raise ImportError('COMPRESSION_LZ4 needs the lz4 package')
+        if not 0 < chunk_size <= _MAX_CHUNK_SIZE:
+            raise ValueError(f'chunk_size must be between 1 and {_MAX_CHUNK_SIZE}')
         self.address = address
         self.address_port = address_port
         self._local_port = local_port
-        self._socket = socket(AF_INET, SOCK_DGRAM)
+        self._integrity = integrity
+        self._chunk_size = chunk_size
+        self._discover_chunk_size = discover_chunk_size
+        self._sack = sack
+        self._compression = compression
+        self._batch_size = batch_size
+        self._batch_linger = batch_linger
+        # (destination, datagram_type) -> _MessageBatch being filled
+        self._batches = {}
+        self._batch_condition = Condition()
+        self._batch_thread = None
+        # probe_id -> size of the probe that got a reply
+        self._probe_replies = {}
+        self._probe_event = Event()
+        self._owns_socket = sock is None
+        self._socket = self._create_socket() if sock is None else sock
+        # Every sending thread packs its headers into its own reusable buffers
+        self._thread_local = local()
+        self._io = None
         self._package_ID = 0
         self._reliable_datagrams_info = {}
+        self._is_bound = False
         self._is_closed = False
         self._mutex = Lock()
+        # Notified every time a reliable package is fully acknowledged
+        self._package_done = Condition(self._mutex)
+        self._congestion = _CongestionWindow(self._AWAIT_TIME)
+        # Retransmission timers of every package: heap of (deadline, package_id, subpackage_id)
+        self._timers = []
+        self._timers_condition = Condition()
+        self._dispatcher_thread = None
+        self._retransmit_thread = None
+        self._metrics = Metrics({'package_latency': LATENCY_BUCKETS, 'retransmissions_per_package': COUNT_BUCKETS})
+        self._datagrams_sent = 0
+        self._datagrams_received = 0
+        self._bytes_sent = 0
+        self._compressed_packages = 0
+        self._compression_saved_bytes = 0
+        self._batches_sent = 0
+        self._batched_messages = 0
+        self._retransmissions = 0
+        self._fast_retransmissions = 0
+        self._chunks_given_up = 0
+        self._packages_failed = 0
+        # Packages failed since the last flush()
+        self._unflushed_failures = 0
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @property
+    def window_size(self):
+        return self._congestion.size
+
+    @property
+    def retransmit_rate(self):
+        if self._datagrams_sent == 0:
+            return 0.0
+        return self._retransmissions / self._datagrams_sent
+
+    def stats(self):
+        return {
+            'window_size': self._congestion.size,
+            'ssthresh': self._congestion.ssthresh,
+            'in_flight': self._congestion.in_flight,
+            'srtt': self._congestion.srtt,
+            'rto': self._congestion.rto,
+            'datagrams_sent': self._datagrams_sent,
+            'datagrams_received': self._datagrams_received,
+            'bytes_sent': self._bytes_sent,
+            'bytes_per_second': self._metrics.rate(self._bytes_sent),
+            'compressed_packages': self._compressed_packages,
+            'compression_saved_bytes': self._compression_saved_bytes,
+            'batches_sent': self._batches_sent,
+            'batched_messages': self._batched_messages,
+            'retransmissions': self._retransmissions,
+            'fast_retransmissions': self._fast_retransmissions,
+            'retransmit_rate': self.retransmit_rate,
+            'chunks_given_up': self._chunks_given_up,
+            'packages_failed': self._packages_failed,
+            'pending_packages': len(self._reliable_datagrams_info),
+            'histograms': self._metrics.snapshot(),
+        }
+
+    # hook(event, info) is called on 'package_acknowledged', 'package_failed' (some chunks were given up),
+    # 'retransmission' and 'chunk_given_up'
+    def add_hook(self, hook):
+        self._metrics.add_hook(hook)
+
+    def remove_hook(self, hook):
+        self._metrics.remove_hook(hook)
 
     def send_json(self, data, datagram_type, destination):
         json_bytes = json.dumps(data).encode(encoding='utf-8')
         self.send_data(json_bytes, datagram_type, destination)
 
     def send_data(self, data, datagram_type, destination):
-        unique_package_id = self._package_ID #Gurdamos el id por seguridad, ya que igual otros threads mas adelante lo modifican.
+        if self._batch_size and not hasattr(data, 'read') and len(data) + _BATCH_LENGTH.size <= self._batch_size:
+            self._add_to_batch(data, datagram_type, destination)
+            return
+        if self._batches:
+            # Messages queued before this package go out first
+            self._flush_batches((destination, datagram_type))
+        self._send_package(data, datagram_type, destination)
+
+    # options: flags of the package besides integrity, SACK and compression
+    def _send_package(self, data, datagram_type, destination, options=0):
+        # Reserve the id up front, other threads may be sending at the same time.
+        self._mutex.acquire()
+        unique_package_id = self._package_ID
+        self._package_ID += 1
+        self._mutex.release()
 
         is_reliable = datagram_type == self._DATAGRAM_RELIABLE
         self._bound_socket()
 
+        data, compression = self._compress_payload(data)
+
         #Dividir los datos.
-        data_splitted = self._split(data)
+        number_of_subpackages, chunks = self._split(data)
 
         #Realizar la estructura de datos
         if is_reliable:
-            self._initialize_structure_for_reliable(len(data_splitted), unique_package_id)
-            # Thread: Preparar el ack listener
-            listen_ack_thread = Thread(target=self._ack_listener, args=[unique_package_id])
-            listen_ack_thread.start()
+            self._initialize_structure_for_reliable(number_of_subpackages, unique_package_id, destination)
 
-        #Thread: Enviar datos
+        self._send(chunks, number_of_subpackages, datagram_type, destination, unique_package_id, is_reliable,
+                   options | compression << _COMPRESSION_SHIFT)
 
-        self._send(data_splitted, datagram_type, destination, unique_package_id, is_reliable)
+    def flush(self, timeout=None):
+        # Sends the pending batches and blocks until every reliable package sent so far is acknowledged or failed.
+        # Returns False on timeout or when some package failed since the previous flush.
+        self._flush_batches()
+        with self._package_done:
+            finished = self._package_done.wait_for(lambda: not self._reliable_datagrams_info, timeout)
+            failures, self._unflushed_failures = self._unflushed_failures, 0
+        return finished and not failures
 
-        #Activar monitor
+    def close(self, timeout=None):
+        self.flush(timeout)
+        self._is_closed = True
+        with self._timers_condition:
+            self._timers_condition.notify()
+        with self._batch_condition:
+            self._batch_condition.notify()
+        self._unbound_socket()
 
-        if is_reliable:
-            resend_monitor = Thread(target=self._ack_resend_monitor, args=[unique_package_id, destination])
-            resend_monitor.start()
+    def _add_to_batch(self, data, datagram_type, destination):
+        self._bound_socket()
+        key = (destination, datagram_type)
+        full = None
+        with self._batch_condition:
+            batch = self._batches.get(key)
+            if batch is not None and len(batch.data) + _BATCH_LENGTH.size + len(data) > self._batch_size:
+                full = self._batches.pop(key)
+                batch = None
+            if batch is None:
+                batch = self._batches[key] = _MessageBatch(time.time() + self._batch_linger)
+                self._batch_condition.notify()
+            batch.add(data)
+        if full is not None:
+            self._send_batch(key, full)
 
-        #self._unbound_socket()
+    # key: only the batch of that (destination, datagram_type), all of them by default
+    def _flush_batches(self, key=None):
+        with self._batch_condition:
+            keys = list(self._batches) if key is None else [key] if key in self._batches else []
+            batches = [(key, self._batches.pop(key)) for key in keys]
+        for key, batch in batches:
+            self._send_batch(key, batch)
+
+    def _send_batch(self, key, batch):
+        destination, datagram_type = key
+        self._batches_sent += 1
+        self._batched_messages += batch.messages
+        self._send_package(batch.data, datagram_type, destination, _OPTION_BATCH)
+
+    # Sends every batch batch_linger seconds after its first message, unless it was filled before
+    def _batch_loop(self):
+        while not self._is_closed:
+            with self._batch_condition:
+                now = time.time()
+                expired = [(key, batch) for key, batch in self._batches.items() if batch.deadline <= now]
+                if not expired:
+                    deadline = min((batch.deadline for batch in self._batches.values()), default=None)
+                    self._batch_condition.wait(deadline - now if deadline is not None else None)
+                    continue
+                for key, _ in expired:
+                    del self._batches[key]
+
+            for key, batch in expired:
+                try:
+                    self._send_batch(key, batch)
+                except OSError as e:
+                    if not self._is_closed:
+                        _logger.error('Batch send failed: %s', e)
+
+    def _send(self, chunks, number_of_subpackages, datagram_type, destination, unique_package_id, is_reliable,
+              options=0):
+        chunks = enumerate(chunks)
+        header_buffers = self._header_buffers()
+        package_hash = self._new_package_hash()
+        package = self._reliable_datagrams_info[unique_package_id] if is_reliable else None
+        while True:
+            # Reliable chunks go out as far as the window lets them, the rest in full batches
+            if is_reliable:
+                slots = self._congestion.acquire_slots(self._SEND_BATCH)
+            else:
+                slots = self._SEND_BATCH
+            batch = list(islice(chunks, slots))
+            if is_reliable and len(batch) < slots:
+                self._congestion.release_slot(slots - len(batch))
+            if not batch:
+                break
+
+            outgoing = []
+            for position, (i, chunk) in enumerate(batch):
+                # Reliable headers are kept for retransmissions, they are packed into the package state
+                buffer = package.header(i) if is_reliable else header_buffers[position]
+                header = self._pack_header(datagram_type, unique_package_id, number_of_subpackages, i, chunk,
+                                           package_hash=package_hash, buffer=buffer, options=options)
+                outgoing.append(((header, chunk), destination))
 
-    def _send(self, data_splitted, datagram_type, destination, unique_package_id, is_reliable):
-        for i, chunk in enumerate(data_splitted):
-            hash = sha256(chunk).digest()
-            chunk = datagram_type.to_bytes(4, 'little') + unique_package_id.to_bytes(4, 'little') + hash \
-                    + len(data_splitted).to_bytes(4, 'little') + i.to_bytes(4, 'little') + chunk
-            self._socket.sendto(chunk, destination)
             if is_reliable:
-                self._reliable_datagrams_info[unique_package_id]['backup_data'][i] = chunk
-                self._reliable_datagrams_info[unique_package_id]['last_send_time'][i] = time.time()
+                self._mutex.acquire()
+                send_time = time.time()
+                for i, chunk in batch:
+                    package.chunks[i] = chunk
+                    package.last_send_time[i] = send_time
+                self._mutex.release()
+                for i, _ in batch:
+                    self._schedule_retransmission(unique_package_id, i, send_time + self._congestion.rto)
 
+            self._io.send_batch(outgoing)
+            self._datagrams_sent += len(outgoing)
+            self._bytes_sent += sum(len(chunk) for _, chunk in batch)
+
+    def _new_package_hash(self):
+        if self._integrity in (INTEGRITY_CRC32, INTEGRITY_XXHASH):
+            return sha256()
+        return None
+
+    # Chunks have to be packed in order, package_hash is fed with every one of them. options holds the package
+    # flags, integrity and SACK are added here.
+    def _pack_header(self, datagram_type, package_id, number_of_subpackages, subpackage_id, chunk,
+                     package_hash=None, buffer=None, options=0):
+        if self._integrity == INTEGRITY_SHA256:
+            hash = sha256(chunk).digest()
+        elif self._integrity == INTEGRITY_NONE:
+            hash = b''
+        else:
+            package_hash.update(chunk)
+            hash = _chunk_checksum(self._integrity, chunk)
+            if subpackage_id == number_of_subpackages - 1:
+                hash += package_hash.digest()[:_PACKAGE_DIGEST_SIZE]
+        options |= self._integrity | (_OPTION_SACK if self._sack else 0)
+        # The original chunk size is sent as 0, so that old servers still accept it
+        chunk_size = 0 if self._chunk_size == _DEFAULT_CHUNK_SIZE else self._chunk_size
+        if buffer is None:
+            return _HEADER.pack(datagram_type, options, chunk_size, package_id, hash, number_of_subpackages,
+                                subpackage_id)
+        _HEADER.pack_into(buffer, 0, datagram_type, options, chunk_size, package_id, hash, number_of_subpackages,
+                          subpackage_id)
+        return buffer
+
+    def _header_buffers(self):
+        buffers = getattr(self._thread_local, 'headers', None)
+        if buffers is None:
+            buffers = self._thread_local.headers = [bytearray(_HEADER.size) for _ in range(self._SEND_BATCH)]
+        return buffers
+
+    def _create_socket(self):
+        return socket(AF_INET, SOCK_DGRAM)
+
+    def _send_datagram(self, header, payload, address):
+        # Scatter/gather: header and payload go to the kernel as they are, without building a new bytes object
+        if hasattr(self._socket, 'sendmsg'):
+            self._socket.sendmsg((header, payload), (), 0, address)
+        else:
+            self._socket.sendto(bytes(header) + payload, address)
+
+    def _initialize_structure_for_reliable(self, data_length, unique_package_id, destination):
         self._mutex.acquire()
-        self._package_ID += 1
+        if unique_package_id not in self._reliable_datagrams_info:
+            self._reliable_datagrams_info[unique_package_id] = _ReliablePackage(data_length, destination,
+                                                                                self._SEND_ATTEMPTS)
         self._mutex.release()
 
-    def _initialize_structure_for_reliable(self, data_length, unique_package_id):
-        if unique_package_id not in self._reliable_datagrams_info.keys():
-            self._reliable_datagrams_info[unique_package_id] = {}
-            self._reliable_datagrams_info[unique_package_id]['acks'] = [False for _ in range(data_length)]
-            self._reliable_datagrams_info[unique_package_id]['remaining_acks'] = data_length
-            self._reliable_datagrams_info[unique_package_id]['backup_data'] = [None for _ in range(data_length)]
-            self._reliable_datagrams_info[unique_package_id]['remaining_attempts'] = [self._SEND_ATTEMPTS for _ in range(data_length)]
-            self._reliable_datagrams_info[unique_package_id]['last_send_time'] = [None for _ in range(data_length)]
+    # Returns the data to send and its compression. Sources are compressed piece by piece, files are not read whole
+    # into memory (the compressed package is).
+    def _compress_payload(self, data):
+        if self._compression == COMPRESSION_NONE:
+            return data, COMPRESSION_NONE
+        if hasattr(data, 'read'):
+            position = data.tell()
+            pieces = iter(lambda: data.read(_COMPRESSION_PIECE), b'')
+        else:
+            view = memoryview(data).cast('B')
+            pieces = (view[i:i + _COMPRESSION_PIECE] for i in range(0, len(view), _COMPRESSION_PIECE))
+        first = next(pieces, b'')
+        sample = first[:_COMPRESSION_SAMPLE]
+        # Packages that fit in one chunk gain nothing, incompressible ones (already compressed media) lose time
+        if len(first) <= self._chunk_size or \
+                len(_compress(self._compression, [sample], level=1)) > len(sample) * _COMPRESSION_MIN_RATIO:
+            if hasattr(data, 'read'):
+                data.seek(position)
+            return data, COMPRESSION_NONE
+        size = 0
 
+        def counted(pieces):
+            nonlocal size
+            for piece in pieces:
+                size += len(piece)
+                yield piece
+
+        compressed = _compress(self._compression, counted(chain([first], pieces)))
+        if hasattr(data, 'read'):
+            data.seek(position)
+        self._compressed_packages += 1
+        self._compression_saved_bytes += size - len(compressed)
+        return compressed, self._compression
+
+    # Returns the number of chunks and an iterator over them. Chunks are memoryview slices of the source, nothing
+    # is copied. Files are mapped when possible, otherwise they are read chunk by chunk while sending. Either way
+    # the file position is left where it was, the same file can be sent again.
     def _split(self, data):
-        result = []
-        while len(data) > self._CHUNK_SIZE:
-            result.append(data[:self._CHUNK_SIZE])
-            data = data[self._CHUNK_SIZE:]
-        result.append(data)
-        return result
-
-
-    def _get_number_remaining_acks(self, package_id):
-        remaining_acks = self._reliable_datagrams_info[package_id].get('remaining_acks', 0)
-        return remaining_acks
-
-    #Se creará un ack listener por cada paquete. De esta manera si se están recibiendo 5 paquetes a la vez, se
-    #tendrán 5 ack listeners pada aliviar trabajo. Cada uno estará corriendo mientras no se acabae un paquete en concreto.
-    def _ack_listener(self, unique_package_id):
-        while self._get_number_remaining_acks(unique_package_id) > 0:
+        if hasattr(data, 'read'):
+            return self._split_file(data)
+        view = memoryview(data).cast('B')
+        chunk_size = self._chunk_size
+        number_of_subpackages = max(math.ceil(len(view) / chunk_size), 1)
+        return number_of_subpackages, (view[i * chunk_size:(i + 1) * chunk_size] for i in range(number_of_subpackages))
+
+    def _split_file(self, file):
+        position = file.tell()
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            # Not backed by a mappable file (BytesIO, pipes, empty files...)
+            size = file.seek(0, io.SEEK_END) - position
+            file.seek(position)
+            chunk_size = self._chunk_size
+            number_of_subpackages = max(math.ceil(size / chunk_size), 1)
+
+            def read_chunks():
+                for _ in range(number_of_subpackages):
+                    yield file.read(chunk_size)
+                file.seek(position)
+
+            return number_of_subpackages, read_chunks()
+        return self._split(memoryview(mapped)[position:])
+
+    # One dispatcher per client: every datagram arriving to the socket is read here and routed to its package.
+    def _dispatch_loop(self):
+        while not self._is_closed:
             try:
-                datagram, address = self._socket.recvfrom(4096)
+                batch = self._io.recv_batch()
             except OSError as e:
-                print(e)
+                if not self._is_closed:
+                    _logger.error('Receive failed: %s', e)
+                continue
+            if self._is_closed:
+                # Woken up by the shutdown in close()
+                return
+            for datagram, address in batch:
+                self._dispatch_datagram(datagram, address)
+            self._dispatched_batch()
+
+    def _dispatched_batch(self):
+        # Called once every datagram of a received batch is dispatched
+        pass
 
-            datagram_type = int.from_bytes(datagram[:4], 'little')
+    def _dispatch_datagram(self, datagram, address):
+        self._datagrams_received += 1
+        # Truncated datagrams are ignored before any field is read
+        datagram_type = datagram[0] if datagram else None
+
+        if datagram_type == self._DATAGRAM_ACK and len(datagram) >= _ACK_SIZE:
             package_id = int.from_bytes(datagram[4:8], 'little')
             subpackage_id = int.from_bytes(datagram[8:12], 'little')
+            _logger.debug('ACK received, Package id:%s, subpackageid:%s', package_id, subpackage_id)
+            self._mark_subpackage(package_id, subpackage_id)
+        elif datagram_type == self._DATAGRAM_SACK and len(datagram) >= _SACK.size:
+            _, package_id, cumulative = _SACK.unpack_from(datagram)
+            _logger.debug('SACK received, Package id:%s, up to:%s', package_id, cumulative)
+            self._mark_subpackages(package_id, cumulative, bytes(datagram[_SACK.size:]))
+        elif datagram_type == self._DATAGRAM_NACK and len(datagram) >= _NACK.size:
+            _, package_id, count = _NACK.unpack_from(datagram)
+            subpackage_ids = [int.from_bytes(datagram[offset:offset + 4], 'little')
+                              for offset in range(_NACK.size, min(len(datagram), _NACK.size + 4 * count), 4)]
+            _logger.debug('NACK received, Package id:%s, missing:%s', package_id, len(subpackage_ids))
+            self._fast_retransmit(package_id, subpackage_ids)
+        elif datagram_type == self._DATAGRAM_PROBE_REPLY and len(datagram) >= _PROBE_REPLY.size:
+            _, probe_id, size = _PROBE_REPLY.unpack_from(datagram)
+            self._probe_replies[probe_id] = size
+            self._probe_event.set()
+
+    def discover_chunk_size(self, destination=None):
+        # Sends one probe of every size in _PROBE_SIZES with fragmentation disabled and keeps the largest one that
+        # got a reply. Servers that don't know probes never reply, then chunk_size is kept.
+        destination = destination or (self.address, self.address_port)
+        self._bound_socket()
+        restore_fragmentation = self._disable_fragmentation()
+        self._probe_replies.clear()
+        try:
+            # Probes are plain datagrams and can be lost too, the ones without reply are sent again
+            for _ in range(self._PROBE_ATTEMPTS):
+                for probe_id, size in enumerate(self._PROBE_SIZES):
+                    if probe_id in self._probe_replies:
+                        continue
+                    probe = bytearray(size)
+                    _PROBE.pack_into(probe, 0, self._DATAGRAM_PROBE, probe_id)
+                    try:
+                        self._socket.sendto(probe, destination)
+                    except OSError:
+                        # Larger than the MTU of the local interface
+                        continue
+                deadline = time.time() + self._PROBE_TIMEOUT
+                while len(self._probe_replies) < len(self._PROBE_SIZES) and time.time() < deadline:
+                    self._probe_event.wait(deadline - time.time())
+                    self._probe_event.clear()
+                if 0 in self._probe_replies:
+                    # The largest size got through, no need to wait for the others
+                    break
+        finally:
+            restore_fragmentation()
+
+        if self._probe_replies:
+            self._chunk_size = min(max(self._probe_replies.values()) - _HEADER.size, _MAX_CHUNK_SIZE)
+        _logger.info('Chunk size for %s: %s', destination, self._chunk_size)
+        return self._chunk_size
 
-            if datagram_type == self._DATAGRAM_ACK:
-                print(f'ACK received, type: {datagram_type}, Package id:{package_id}, subpackageid:{subpackage_id}')
-                self._mark_subpackage(package_id, subpackage_id)
+    def _disable_fragmentation(self):
+        # Linux only, elsewhere probes may be fragmented and the result is an upper bound
+        option = getattr(_socket, 'IP_MTU_DISCOVER', 10 if sys.platform.startswith('linux') else None)
+        if option is None:
+            return lambda: None
+        previous = self._socket.getsockopt(IPPROTO_IP, option)
+        self._socket.setsockopt(IPPROTO_IP, option, getattr(_socket, 'IP_PMTUDISC_DO', 2))
+        return lambda: self._socket.setsockopt(IPPROTO_IP, option, previous)
 
-        # Todo: Export data to txt
-        self._clean_package_register(unique_package_id)
+    def _clean_package_register(self, package_id, failed=False):
+        # Must be called holding the mutex
+        del self._reliable_datagrams_info[package_id]
+        if failed:
+            self._packages_failed += 1
+            self._unflushed_failures += 1
+        self._package_done.notify_all()
 
-    def _clean_package_register(self, package_id_listener):
-        self._reliable_datagrams_info[package_id_listener].clear()
+    def _report_package(self, package_id, package):
+        # Called once the mutex is released, so that hooks can send
+        latency = time.time() - package.started
+        self._metrics.observe('retransmissions_per_package', package.retransmissions)
+        if package.given_up:
+            # Part of the package never reached the server, its latency is not a delivery latency
+            self._metrics.emit('package_failed', package_id=package_id, latency=latency,
+                               retransmissions=package.retransmissions, chunks_given_up=package.given_up)
+            return
+        self._metrics.observe('package_latency', latency)
+        self._metrics.emit('package_acknowledged', package_id=package_id, latency=latency,
+                           retransmissions=package.retransmissions)
 
     def _bound_socket(self):
-        try:
-            self._socket.bind(('localhost', self._local_port))
-            print(f'Socket bound on port {self._local_port}, host {self.address}')
-        except OSError as e:
-            print(f"Error binding port {self._local_port}, host {self.address}")
-            print(e)
+        if self._is_bound:
+            return
+        if self._owns_socket:
+            try:
+                self._socket.bind(('localhost', self._local_port))
+            except OSError as e:
+                # Without a bound socket nothing could be sent nor acknowledged
+                _logger.error('Error binding port %s, host %s: %s', self._local_port, self.address, e)
+                raise
+            _logger.info('Socket bound on port %s, host %s', self._local_port, self.address)
+        self._is_bound = True
+        self._io = DatagramIO(self._socket, buffer_size=self._RECEIVE_BUFFER_SIZE)
+        self._start_threads()
+        if self._discover_chunk_size:
+            self.discover_chunk_size()
+
+    def _start_threads(self):
+        if self._owns_socket:
+            self._dispatcher_thread = Thread(target=self._dispatch_loop, daemon=True)
+            self._dispatcher_thread.start()
+        self._retransmit_thread = Thread(target=self._retransmit_loop, daemon=True)
+        self._retransmit_thread.start()
+        if self._batch_size:
+            self._batch_thread = Thread(target=self._batch_loop, daemon=True)
+            self._batch_thread.start()
 
     def _unbound_socket(self):
-        self._socket.close()
-        print(f'Socket closed on port {self._local_port}, host {self.address}')
+        if not self._owns_socket:
+            return
+        _shutdown_socket(self._socket)
+        for thread in (self._dispatcher_thread, self._retransmit_thread, self._batch_thread):
+            if thread is not None and thread is not current_thread():
+                thread.join()
+        _logger.info('Socket closed on port %s, host %s', self._local_port, self.address)
 
     def _mark_subpackage(self, package_id, subpackage_id):
+        self._mark_subpackages(package_id, subpackage_id + 1, b'', first_unacked=subpackage_id)
+
+    # Applies a whole selective ACK with one lock acquisition: the chunks from first_unacked (by default the first
+    # one not acknowledged yet) up to cumulative, plus the ones set in bitmap
+    def _mark_subpackages(self, package_id, cumulative, bitmap, first_unacked=None):
+        rtt_sample = None
+        newly_acked = 0
         self._mutex.acquire()
-        if self._reliable_datagrams_info[package_id]['remaining_acks'] > 0:
-            self._reliable_datagrams_info[package_id]['acks'][subpackage_id] = True
-            self._reliable_datagrams_info[package_id]['remaining_acks'] -= 1
-            self._reliable_datagrams_info[package_id]['backup_data'][subpackage_id] = None
+        package = self._reliable_datagrams_info.get(package_id)
+        if package is None:
+            # Late or duplicated ACK
+            self._mutex.release()
+            return
+        acks = package.acks
+        if first_unacked is None:
+            first_unacked = package.acked_until
+        now = time.time()
+        for subpackage_id in _sack_subpackages(min(cumulative, len(acks)), bitmap, first_unacked):
+            if subpackage_id >= len(acks) or acks[subpackage_id]:
+                continue
+            package.acknowledge(subpackage_id)
+            newly_acked += 1
+            # Karn's rule: a retransmitted chunk gives an ambiguous RTT, skip the sample
+            if package.remaining_attempts[subpackage_id] == self._SEND_ATTEMPTS:
+                rtt_sample = now - package.last_send_time[subpackage_id]
+        # acks.find is a C scan for the next hole, -1 when there is none
+        acked_until = acks.find(0, package.acked_until)
+        package.acked_until = len(acks) if acked_until == -1 else acked_until
+        completed = package.remaining_acks == 0
+        if completed:
+            self._clean_package_register(package_id, failed=package.given_up > 0)
         self._mutex.release()
+        if newly_acked:
+            self._congestion.on_acks(newly_acked, rtt_sample)
+        if completed:
+            self._report_package(package_id, package)
 
-    def _ack_resend_monitor(self, unique_package_id, destination):
-        while self._get_number_remaining_acks(unique_package_id) > 0:
-            time.sleep(0.5)
-            self._resend_data(unique_package_id, destination)
+    def _fast_retransmit(self, package_id, subpackage_ids):
+        # The threaded client sends all of them in one batch, the async one has no DatagramIO and sends them directly
+        outgoing = [] if self._io is not None else None
+        resent = False
+        for subpackage_id in subpackage_ids:
+            resent |= self._resend_data(package_id, subpackage_id, outgoing, nacked=True)
+        if resent:
+            self._congestion.on_loss()
+        if outgoing:
+            self._io.send_batch(outgoing)
 
-        print("Closing monitor.")
+    def _schedule_retransmission(self, package_id, subpackage_id, deadline):
+        with self._timers_condition:
+            heapq.heappush(self._timers, (deadline, package_id, subpackage_id))
+            if self._timers[0][0] == deadline:
+                self._timers_condition.notify()
 
-    #Todo: limpiar
-    def _resend_data(self, package_id, destination):
+    # One timer loop for every package: sleeps until the earliest deadline and handles all the expired ones.
+    def _retransmit_loop(self):
+        while not self._is_closed:
+            with self._timers_condition:
+                now = time.time()
+                if not self._timers or self._timers[0][0] > now:
+                    self._timers_condition.wait(self._timers[0][0] - now if self._timers else None)
+                    continue
+                expired = []
+                while self._timers and self._timers[0][0] <= now:
+                    expired.append(heapq.heappop(self._timers))
+
+            timed_out = False
+            outgoing = []
+            for _, package_id, subpackage_id in expired:
+                timed_out |= self._resend_data(package_id, subpackage_id, outgoing)
+            if timed_out:
+                self._congestion.on_timeout()
+            try:
+                self._io.send_batch(outgoing)
+            except OSError as e:
+                if not self._is_closed:
+                    _logger.error('Retransmission failed: %s', e)
+
+    # nacked: the server reported the chunk missing, it is resent without waiting for its timer
+    def _resend_data(self, package_id, subpackage_id, outgoing=None, nacked=False):
+        # Retransmissions are appended to outgoing when given, so that all of them are sent in one batch
         self._mutex.acquire()
-        remaining_acks = [i for i, x in enumerate(self._reliable_datagrams_info[package_id]['acks']) if not x]
-        self._mutex.release()
+        package = self._reliable_datagrams_info.get(package_id)
+        if package is None or subpackage_id >= len(package.acks) or package.acks[subpackage_id] or \
+                package.chunks[subpackage_id] is None:
+            # Timers are not cancelled on ACK, they are discarded here. NACKs can arrive for chunks not sent yet.
+            self._mutex.release()
+            return False
+
+        # Exponential backoff over the estimated RTO for every retry of the same chunk
+        attempts_used = self._SEND_ATTEMPTS - package.remaining_attempts[subpackage_id]
+        deadline = package.last_send_time[subpackage_id] + self._congestion.rto * (2 ** attempts_used)
+        if nacked:
+            # At most one fast retransmission per round trip, several NACKs can report the same gap. Giving up is
+            # left to the timer.
+            since_last_send = time.time() - package.last_send_time[subpackage_id]
+            if package.remaining_attempts[subpackage_id] == 0 or \
+                    since_last_send < (self._congestion.srtt or self._congestion.rto):
+                self._mutex.release()
+                return False
+        elif time.time() < deadline:
+            # The RTO shrank or grew since the timer was set
+            self._mutex.release()
+            self._schedule_retransmission(package_id, subpackage_id, deadline)
+            return False
+
+        if package.remaining_attempts[subpackage_id] == 0:
+            _logger.warning('Giving up subpackage %s of package %s', subpackage_id, package_id)
+            package.acknowledge(subpackage_id)
+            package.given_up += 1
+            self._chunks_given_up += 1
+            completed = package.remaining_acks == 0
+            if completed:
+                self._clean_package_register(package_id, failed=True)
+            self._mutex.release()
+            self._congestion.release_slot()
+            self._metrics.emit('chunk_given_up', package_id=package_id, subpackage_id=subpackage_id)
+            if completed:
+                self._report_package(package_id, package)
+            return True
 
-        if not remaining_acks: #if list is empty
-            pass
+        _logger.debug('Resending subpackage %s of package %s', subpackage_id, package_id)
+        header, chunk = package.header(subpackage_id), package.chunks[subpackage_id]
+        if outgoing is not None:
+            outgoing.append(((header, chunk), package.destination))
         else:
-            for ack_location in remaining_acks:
-                _data_exists = self._reliable_datagrams_info[package_id].get('backup_data', None)
-                _elapsed_time_list = self._reliable_datagrams_info[package_id].get('last_send_time', None)
-                _elapsed_time = _elapsed_time_list[ack_location]
-                if _data_exists is not None:
-                    if _elapsed_time is not None:
-                        if time.time() - _elapsed_time > self._AWAIT_TIME:
-                            print(f'Resending subpackage {ack_location} of package {package_id}')
-                            self._socket.sendto(_data_exists[ack_location], destination)
-                            self._reliable_datagrams_info[package_id]['remaining_attempts'][ack_location] -= 1
-                            self._reliable_datagrams_info[package_id]['last_send_time'][ack_location] = time.time()
-                            if self._reliable_datagrams_info[package_id]['remaining_attempts'][ack_location] == 0:
-                                self._reliable_datagrams_info[package_id]['acks'][ack_location] = True
+            self._send_datagram(header, chunk, package.destination)
+        package.last_send_time[subpackage_id] = time.time()
+        self._datagrams_sent += 1
+        self._retransmissions += 1
+        package.retransmissions += 1
+        if nacked:
+            # The first copy was reported missing, so the ACK can only be for this one and no attempt is used up.
+            # The pending timer of the chunk reschedules itself from the new last_send_time.
+            self._fast_retransmissions += 1
+            self._mutex.release()
+            self._metrics.emit('retransmission', package_id=package_id, subpackage_id=subpackage_id, fast=True)
+            return True
+        package.remaining_attempts[subpackage_id] -= 1
+        next_deadline = time.time() + self._congestion.rto * (2 ** (attempts_used + 1))
+        self._mutex.release()
+        self._schedule_retransmission(package_id, subpackage_id, next_deadline)
+        self._metrics.emit('retransmission', package_id=package_id, subpackage_id=subpackage_id, fast=False)
+        return True
 
 
 
@@ -0,0 +1,252 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from socket import gethostbyname
+from struct import Struct
+from threading import Lock, Timer
+
+from TapNet.handlerPool import BACKPRESSURE_BLOCK, BACKPRESSURE_PAUSE_ACKS
+from TapNet.netLibrary import Server, Client, _HEADER, _MAX_CHUNK_SIZE
+
+_logger = logging.getLogger(__name__)
+
+
+# Request/response on top of Server and Client. Requests and replies are reliable packages whose payload starts
+# with an _RPC header: kind and call_id. The server answers on its own socket to the address the request came from,
+# the client reads replies on the socket it sends from, so every call is matched by (address, call_id).
+# Calls are pipelined: call() returns a Future right after the request is handed to the congestion window.
+
+# kind, 3 padding bytes, call_id
+_RPC = Struct('<B 3x I')
+_RPC_REQUEST = 0
+_RPC_REPLY = 1
+_RPC_ERROR = 2
+
+
+class RpcError(Exception):
+    # The handler of the call failed on the server, the message is its repr
+    pass
+
+
+class RpcServer(Server):
+    # handler(data) gets the request payload and returns the reply payload (bytes like, None for an empty reply).
+    # Exceptions are sent back and raised by the caller's Future.
+    # Replies wait for the congestion window, which only opens while the listen loop reads their ACKs: handlers run
+    # in a HandlerPool of handler_workers threads and the listen loop must never wait for it, the backpressure
+    # policy can't be block. A batch of requests takes one queue slot per request.
+    # reply_options are passed to the Client that sends the replies (integrity, compression, batch_size...).
+    # server_options are the ones of Server, except stream_handler, deliver_batches and handler_processes.
+    def __init__(self, address=None, port=None, handler=None, handler_workers=4, handler_queue_size=1024,
+                 backpressure=BACKPRESSURE_PAUSE_ACKS, reply_options=None, **server_options):
+        if handler_workers < 1:
+            raise ValueError('RpcServer needs at least one handler worker')
+        if backpressure == BACKPRESSURE_BLOCK:
+            raise ValueError('RpcServer handlers send replies, the listen loop can not block on them')
+        super().__init__(address, port, self._serve, handler_workers=handler_workers,
+                         handler_queue_size=handler_queue_size, backpressure=backpressure, **server_options)
+        self._request_handler = handler
+        self._replies = Client(sock=self._socket, **(reply_options or {}))
+        self._requests = 0
+        self._request_errors = 0
+
+    def stats(self):
+        stats = super().stats()
+        replies = self._replies.stats()
+        stats.update({
+            'rpc_requests': self._requests,
+            'rpc_errors': self._request_errors,
+            'reply_retransmissions': replies['retransmissions'],
+            'pending_replies': replies['pending_packages'],
+        })
+        return stats
+
+    def end(self, timeout=1):
+        # Requests already acknowledged are served while the socket is open, then the replies get timeout seconds to
+        # be acknowledged
+        self._handlers.close(timeout)
+        self._replies.close(timeout)
+        super().end(timeout)
+
+    def _bound_server(self):
+        super()._bound_server()
+        self._replies._bound_socket()
+
+    def _handle_datagram(self, datagram, address):
+        if datagram and datagram[0] in (self._DATAGRAM_ACK, self._DATAGRAM_SACK, self._DATAGRAM_NACK,
+                           self._DATAGRAM_PROBE_REPLY):
+            # Acknowledgements of our replies
+            self._datagrams_received += 1
+            self._replies._dispatch_datagram(datagram, address)
+        else:
+            super()._handle_datagram(datagram, address)
+
+    def _deliver(self, data, unique_identifier=None, reliable=True):
+        # The handler pool gets the address along with the request
+        super()._deliver((unique_identifier[:2], data), unique_identifier, reliable)
+
+    def _serve(self, request):
+        address, data = request
+        if len(data) < _RPC.size or data[0] != _RPC_REQUEST:
+            _logger.warning('Request from %s without RPC header dropped', address)
+            return
+        _, call_id = _RPC.unpack_from(data)
+        self._requests += 1
+        try:
+            kind, reply = _RPC_REPLY, self._request_handler(data[_RPC.size:]) or b''
+        except Exception as e:
+            _logger.exception('RPC handler failed: %r', e)
+            self._request_errors += 1
+            kind, reply = _RPC_ERROR, repr(e).encode('utf-8')
+        self._replies.send_data(b''.join((_RPC.pack(kind, call_id), reply)), Client._DATAGRAM_RELIABLE, address)
+
+
+class _ReplyServer(Server):
+    # Replies are handed over along with the address they came from
+    def _deliver(self, data, unique_identifier=None, reliable=True):
+        super()._deliver((unique_identifier[:2], data), unique_identifier, reliable)
+
+
+class RpcClient(Client):
+    # Replies can be as large as any package, every receive buffer has to hold the largest chunk
+    _RECEIVE_BUFFER_SIZE = _MAX_CHUNK_SIZE + _HEADER.size
+    _CALL_TIMEOUT = 30
+    _DESTINATION_CACHE_SIZE = 4096
+
+    # Calls without a reply after call_timeout seconds fail with TimeoutError, a timer armed on the earliest deadline
+    # finds them even if the server never answers again.
+    # Future callbacks run on the receive thread (or the timer thread), they have to be quick.
+    # client_options are the ones of Client (integrity, chunk_size, compression, batch_size...).
+    def __init__(self, address=None, address_port=None, local_port=None, call_timeout=_CALL_TIMEOUT,
+                 max_reply_memory=Server._MAX_BUFFER_MEMORY, **client_options):
+        super().__init__(address, address_port, local_port, **client_options)
+        self._call_timeout = call_timeout
+        # call_id -> (future, deadline, destination), in deadline order
+        self._calls = OrderedDict()
+        # Destinations as given -> (ip, port), the address their replies come from
+        self._destinations = {}
+        self._calls_lock = Lock()
+        self._call_id = 0
+        self._expiry_timer = None
+        self._replies = _ReplyServer(handler=self._on_reply, max_buffer_memory=max_reply_memory, sock=self._socket)
+        self._calls_made = 0
+        self._call_timeouts = 0
+        self._call_errors = 0
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            'calls': self._calls_made,
+            'pending_calls': len(self._calls),
+            'call_timeouts': self._call_timeouts,
+            'call_errors': self._call_errors,
+        })
+        return stats
+
+    def call(self, data, destination=None):
+        # Returns a Future with the reply payload (bytes)
+        future = Future()
+        destination = destination or (self.address, self.address_port)
+        address = self._resolve(destination)
+        with self._calls_lock:
+            call_id = self._call_id
+            self._call_id = (self._call_id + 1) & 0xFFFFFFFF
+            self._calls[call_id] = (future, time.time() + self._call_timeout, address)
+            self._calls_made += 1
+        self._expire_calls()
+        self.send_data(b''.join((_RPC.pack(_RPC_REQUEST, call_id), data)), self._DATAGRAM_RELIABLE, destination)
+        return future
+
+    def call_json(self, data, destination=None):
+        # Returns a Future with the decoded JSON reply
+        result = Future()
+
+        def decode(future):
+            if not result.set_running_or_notify_cancel():
+                return
+            try:
+                result.set_result(json.loads(future.result()))
+            except Exception as e:
+                result.set_exception(e)
+
+        self.call(json.dumps(data).encode(encoding='utf-8'), destination).add_done_callback(decode)
+        return result
+
+    def close(self, timeout=None):
+        super().close(timeout)
+        with self._calls_lock:
+            calls, self._calls = self._calls, OrderedDict()
+            if self._expiry_timer is not None:
+                self._expiry_timer.cancel()
+                self._expiry_timer = None
+        for future, _, _ in calls.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ConnectionError('Client closed before the reply arrived'))
+
+    def _dispatch_datagram(self, datagram, address):
+        if datagram and datagram[0] in (self._DATAGRAM_NORMAL, self._DATAGRAM_RELIABLE):
+            self._datagrams_received += 1
+            self._replies._handle_datagram(datagram, address)
+        else:
+            super()._dispatch_datagram(datagram, address)
+
+    def _dispatched_batch(self):
+        self._replies._flush_acks()
+        self._expire_calls()
+
+    def _resolve(self, destination):
+        address = self._destinations.get(destination)
+        if address is None:
+            if len(self._destinations) > self._DESTINATION_CACHE_SIZE:
+                self._destinations.clear()
+            address = self._destinations[destination] = (gethostbyname(destination[0]), destination[1])
+        return address
+
+    def _on_reply(self, reply):
+        address, data = reply
+        if len(data) < _RPC.size:
+            return
+        kind, call_id = _RPC.unpack_from(data)
+        with self._calls_lock:
+            call = self._calls.get(call_id)
+            if call is None or call[2] != address:
+                # Reply to a call that already timed out, or from a peer the call was not sent to
+                return
+            del self._calls[call_id]
+        future, _, _ = call
+        if not future.set_running_or_notify_cancel():
+            # Cancelled by the caller
+            return
+        reply = bytes(memoryview(data)[_RPC.size:])
+        if kind == _RPC_ERROR:
+            self._call_errors += 1
+            future.set_exception(RpcError(reply.decode('utf-8', errors='replace')))
+        else:
+            future.set_result(reply)
+
+    def _expire_calls(self):
+        now = time.time()
+        expired = []
+        with self._calls_lock:
+            while self._calls:
+                call_id, (future, deadline, _) = next(iter(self._calls.items()))
+                if deadline > now:
+                    break
+                del self._calls[call_id]
+                expired.append(future)
+            if self._calls and self._expiry_timer is None:
+                # Every call has the same timeout, the first one in the queue is always the next to expire
+                _, deadline, _ = next(iter(self._calls.values()))
+                self._expiry_timer = Timer(deadline - now, self._on_expiry_timer)
+                self._expiry_timer.daemon = True
+                self._expiry_timer.start()
+        self._call_timeouts += len(expired)
+        for future in expired:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(TimeoutError(f'No reply after {self._call_timeout}s'))
+
+    def _on_expiry_timer(self):
+        with self._calls_lock:
+            self._expiry_timer = None
+        self._expire_calls()
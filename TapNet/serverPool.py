@@ -0,0 +1,114 @@
+import logging
+import os
+import time
+from multiprocessing import Process, Queue
+from queue import Empty
+from threading import Thread
+
+from TapNet.metrics import merge_snapshots
+from TapNet.netLibrary import Server
+
+_logger = logging.getLogger(__name__)
+
+
+# Multi-process Server: every worker binds the same port with SO_REUSEPORT and the kernel hashes each sender
+# address to one of them, so all the chunks of a package reach the same worker, where the handler runs.
+# The parent only supervises: it restarts dead workers and aggregates the stats they report.
+
+
+def _report_stats(server, worker_index, stats_queue, interval):
+    while 1:
+        time.sleep(interval)
+        stats_queue.put((worker_index, server.stats()))
+
+
+def _run_worker(worker_index, address, port, handler, server_options, stats_queue, stats_interval):
+    server = Server(address=address, port=port, handler=handler, reuse_port=True, **server_options)
+    reporter = Thread(target=_report_stats, args=[server, worker_index, stats_queue, stats_interval], daemon=True)
+    reporter.start()
+    server.start()
+
+
+class ServerPool:
+    _STATS_INTERVAL = 1
+    _SUPERVISE_INTERVAL = 0.5
+    # Stats that describe the current state of a worker instead of counting, not kept once the worker dies
+    _GAUGES = ('partial_packages', 'reassembly_memory', 'handler_queue_depth', 'bytes_per_second')
+
+    # handler has to be picklable (a module level function) on platforms that spawn processes.
+    # server_options are passed to every worker Server (max_buffer_memory, package_timeout, stream_handler,
+    # handler_workers...). Workers are daemonic processes, handler_processes is not available.
+    def __init__(self, address=None, port=None, handler=None, workers=None, **server_options):
+        self.address = address
+        self.port = port
+        self._handler = handler
+        self._workers = workers or os.cpu_count() or 1
+        self._server_options = server_options
+        self._processes = [None for _ in range(self._workers)]
+        self._stats_queue = Queue()
+        self._worker_stats = {}
+        self._restarts = 0
+        self._running = False
+
+    def start(self):
+        self._running = True
+        for worker_index in range(self._workers):
+            self._start_worker(worker_index)
+        _logger.info('Server pool bound on port %s, host %s, %s workers', self.port, self.address, self._workers)
+        self._supervise_loop()
+
+    def end(self):
+        self._running = False
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join()
+        _logger.info('Connection closed.')
+
+    def stats(self):
+        self._collect_stats()
+        aggregated = {}
+        for worker_stats in self._worker_stats.values():
+            for key, value in worker_stats.items():
+                if key == 'histograms':
+                    histograms = aggregated.setdefault('histograms', {})
+                    for name, snapshot in value.items():
+                        histograms[name] = merge_snapshots(histograms[name], snapshot) if name in histograms \
+                            else snapshot
+                else:
+                    aggregated[key] = aggregated.get(key, 0) + value
+        aggregated['workers'] = self._workers
+        aggregated['workers_alive'] = sum(1 for process in self._processes if process and process.is_alive())
+        aggregated['worker_restarts'] = self._restarts
+        return aggregated
+
+    def _start_worker(self, worker_index):
+        process = Process(target=_run_worker, daemon=True,
+                          args=[worker_index, self.address, self.port, self._handler, self._server_options,
+                                self._stats_queue, self._STATS_INTERVAL])
+        process.start()
+        self._processes[worker_index] = process
+
+    def _supervise_loop(self):
+        while self._running:
+            time.sleep(self._SUPERVISE_INTERVAL)
+            self._collect_stats()
+            for worker_index, process in enumerate(self._processes):
+                if self._running and not process.is_alive():
+                    _logger.warning('Worker %s exited with code %s, restarting it', worker_index, process.exitcode)
+                    # A restarted worker starts its counters from zero, keep the ones of the dead process
+                    last_stats = self._worker_stats.pop(worker_index, {})
+                    self._worker_stats[(worker_index, self._restarts)] = {
+                        key: value for key, value in last_stats.items() if key not in self._GAUGES}
+                    self._restarts += 1
+                    self._start_worker(worker_index)
+
+    def _collect_stats(self):
+        while 1:
+            try:
+                worker_index, worker_stats = self._stats_queue.get_nowait()
+            except Empty:
+                return
+            self._worker_stats[worker_index] = worker_stats
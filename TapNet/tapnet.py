@@ -1,3 +1,22 @@
+import json
+import logging
+from socket import socket, AF_INET, SOCK_DGRAM
+from threading import Thread, current_thread
+
+from TapNet.datagramIO import DatagramIO
+from TapNet.netLibrary import Server, Client, _HEADER, _MAX_CHUNK_SIZE, _shutdown_socket
+
+_logger = logging.getLogger(__name__)
+
+
+class _PeerClient(Client):
+    # Sends through the TapNet socket. Its ACKs are read by the TapNet listen loop and its retransmissions run in
+    # the datagram_check thread, the only thread of its own is the batch linger one (with batch_size).
+    def _start_threads(self):
+        if self._batch_size:
+            self._batch_thread = Thread(target=self._batch_loop, daemon=True)
+            self._batch_thread.start()
+
 
 class TapNet:
     DATAGRAM_ACK = 0
@@ -6,22 +25,88 @@ class TapNet:
 
     CHUNK_SIZE = 2048  # Tamaño de los chunks, en bytes
 
-    def __init__(self, address):
+    # Datagramas que confirman nuestros envíos, el resto son datos para nosotros
+    _CONTROL_TYPES = (Client._DATAGRAM_ACK, Client._DATAGRAM_SACK, Client._DATAGRAM_NACK,
+                      Client._DATAGRAM_PROBE_REPLY)
+
+    # Peer that sends and receives on one socket, with the wire format of netLibrary: a Client can send to it and
+    # it can send to a Server. Two threads whatever the traffic: listen_loop and datagram_check, plus the batch
+    # linger one when send_options has a batch_size.
+    # response_handler(data) runs on the listen loop. Handlers that send reliable packages wait for the congestion
+    # window, which the listen loop opens: they need handler_workers and a backpressure policy other than block.
+    # send_options are passed to the sending Client (integrity, compression, sack...), server_options to the
+    # receiving Server (max_buffer_memory, package_timeout, stream_handler, handler_workers...).
+    def __init__(self, address, response_handler=None, send_options=None, **server_options):
         self.address = address
-        self.paqueteId = 0  # Id del próximo datagrama a enviar
-        self.datagrams_awating_ack = {}  # Paquetes 'confiables' enviados a la espera de confirmación
-        self.cache = {}
+        self.response_handler = response_handler
         self.sock = socket(AF_INET, SOCK_DGRAM)
-        self.response_handler = None
+        self._server = Server(address[0], address[1], handler=self._handle_package, sock=self.sock, **server_options)
+        self._client = _PeerClient(sock=self.sock, **dict({'chunk_size': self.CHUNK_SIZE}, **(send_options or {})))
+        self._io = None
+        self._listen_thread = None
+        self._check_thread = None
+        self._is_closed = False
+
+    @property
+    def paqueteId(self):
+        # Id del próximo paquete a enviar
+        return self._client._package_ID
+
+    @property
+    def datagrams_awating_ack(self):
+        # Paquetes 'confiables' enviados a la espera de confirmación: package_id -> _ReliablePackage
+        return self._client._reliable_datagrams_info
+
+    @property
+    def cache(self):
+        # Paquetes recibidos hace poco: unique_identifier -> completion time. Their late and duplicated chunks are
+        # acknowledged again and dropped.
+        return self._server._packages._completed
 
     def start(self):
-        print('Starting server on  {}'.format(self.address))
-        self.sock = socket(AF_INET, SOCK_DGRAM)
+        _logger.info('Starting server on %s', self.address)
         self.sock.bind(self.address)
-        listen_loop = Thread(target=self.listen_loop)
-        listen_loop.start()
-        datagram_check = Thread(target=self.datagram_check)
-        datagram_check.start()
+        self._io = DatagramIO(self.sock, buffer_size=_MAX_CHUNK_SIZE + _HEADER.size)
+        self._listen_thread = Thread(target=self.listen_loop, daemon=True)
+        self._listen_thread.start()
+        self._check_thread = Thread(target=self.datagram_check, daemon=True)
+        self._check_thread.start()
+        # With discover_chunk_size the probe replies are read by the listen loop, it has to be running
+        self._client._bound_socket()
+
+    def close(self, timeout=None):
+        """
+        Espera a que se confirmen los paquetes confiables enviados y cierra el socket
+        :param timeout: Segundos de espera como máximo, None para esperar sin límite
+        """
+        self._client.close(timeout)
+        self._is_closed = True
+        # close() alone leaves the listen loop blocked in recv
+        _shutdown_socket(self.sock)
+        self._server.end(timeout)
+        for thread in (self._listen_thread, self._check_thread):
+            if thread is not None and thread is not current_thread():
+                thread.join()
+
+    def flush(self, timeout=None):
+        """
+        Espera a que se confirmen todos los paquetes confiables enviados
+        :param timeout: Segundos de espera como máximo, None para esperar sin límite
+        :return: False si se agotó el tiempo
+        """
+        return self._client.flush(timeout)
+
+    def stats(self):
+        return {'received': self._server.stats(), 'sent': self._client.stats()}
+
+    # hook(event, info) gets the events of both the Server and the Client
+    def add_hook(self, hook):
+        self._server.add_hook(hook)
+        self._client.add_hook(hook)
+
+    def remove_hook(self, hook):
+        self._server.remove_hook(hook)
+        self._client.remove_hook(hook)
 
     def send_ack(self, paquete_id, subpaquete_id, to):
         """
@@ -31,8 +116,7 @@ class TapNet:
         :param to: Cliente al que vamos a enviar el ACK
         :return:
         """
-        # TODO: Implementar
-        return
+        self._server._send_ack(paquete_id, subpaquete_id, to)
 
     def send_bytes(self, bytes_to_send, data_type, to):
         """
@@ -41,8 +125,11 @@ class TapNet:
         :param data_type: Tipo de datos a enviar, ACK, NORMAL o RELIABLE
         :param to: Receptor al que vamos a enviar los datos
         """
-        # TODO: Implementar
-        return
+        if self._io is None:
+            raise RuntimeError('TapNet.start() has to be called before sending')
+        if data_type == self.DATAGRAM_ACK:
+            raise ValueError('ACKs are sent with send_ack')
+        self._client.send_data(bytes_to_send, data_type, to)
 
     def send_json(self, json_to_send, data_type, to):
         """
@@ -51,26 +138,40 @@ class TapNet:
         :param data_type: Tipo de datos a enviar, ACK, NORMAL o RELIABLE
         :param to: Cliente al que vamos a enviar los datos
         """
-        # TODO: Implementar
-        #json_bytes = json.dumps(json_to_send).encode(encoding='utf-8')
-        #self.send_bytes(json_bytes, data_type, to)
-        return
+        json_bytes = json.dumps(json_to_send).encode(encoding='utf-8')
+        self.send_bytes(json_bytes, data_type, to)
 
     def listen_loop(self):
         """
         Escucha las peticiones entrantes
         """
-        # TODO: Implementar
-        return
-        while 1:
-            pass
+        server = self._server
+        while not self._is_closed:
+            # ACKs of the received batch are queued and sent together, as in Server
+            server._outgoing = []
+            try:
+                batch = self._io.recv_batch()
+            except OSError as e:
+                server._outgoing = None
+                if not self._is_closed:
+                    _logger.error('Receive failed: %s', e)
+                continue
+            for datagram, address in batch:
+                if datagram and datagram[0] in self._CONTROL_TYPES:
+                    self._client._dispatch_datagram(datagram, address)
+                else:
+                    server._handle_datagram(datagram, address)
+            server._flush_acks()
+            outgoing, server._outgoing = server._outgoing, None
+            self._io.send_batch(outgoing)
 
     def datagram_check(self):
         """
         Comprueba que el estado de los envíos de los datagramas confiables. Realiza su trabajo en otro thread.
         """
-        # TODO: Implementar
-        return
-        while 1:
-            # Loop de comprobación
-            sleep(.5)
\ No newline at end of file
+        # One timer heap for every package sent, see Client._retransmit_loop
+        self._client._retransmit_loop()
+
+    def _handle_package(self, data):
+        if self.response_handler is not None:
+            self.response_handler(data)
@@ -0,0 +1,198 @@
+import argparse
+import json
+import multiprocessing
+import random
+import time
+from threading import Thread
+
+from TapNet.netLibrary import Server, Client, INTEGRITY_SHA256, INTEGRITY_CRC32, INTEGRITY_XXHASH, INTEGRITY_NONE, \
+    COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_LZ4
+from lossyProxy import LossyProxy
+
+
+# Throughput and latency benchmark: one Server and N Clients on loopback, with a LossyProxy between them. Server and
+# proxy run in their own processes so that their CPU time is measured apart from the clients. Payloads, the
+# NORMAL/RELIABLE mix and the impairments come from the seed, two runs with the same arguments send the same traffic.
+
+_INTEGRITY = {'sha256': INTEGRITY_SHA256, 'crc32': INTEGRITY_CRC32, 'xxhash': INTEGRITY_XXHASH,
+              'none': INTEGRITY_NONE}
+_COMPRESSION = {'none': COMPRESSION_NONE, 'zlib': COMPRESSION_ZLIB, 'lz4': COMPRESSION_LZ4}
+
+
+def _run_server(port, stop, results):
+    delivered = {'packages': 0, 'bytes': 0}
+
+    def handler(data):
+        delivered['packages'] += 1
+        delivered['bytes'] += len(data)
+
+    server = Server(address='localhost', port=port, handler=handler)
+    Thread(target=server.start, daemon=True).start()
+    stop.wait()
+    stats = server.stats()
+    results.put({'delivered_packages': delivered['packages'], 'delivered_bytes': delivered['bytes'],
+                 'server_cpu_seconds': time.process_time(), 'server_datagrams_dropped': stats['datagrams_dropped'],
+                 'server_hash_failures': stats['hash_failures'],
+                 'server_decompression_failures': stats['decompression_failures']})
+
+
+def _run_proxy(listen_port, target_port, impairments, stop, results):
+    proxy = LossyProxy(('localhost', listen_port), ('localhost', target_port), **impairments)
+    Thread(target=proxy.start, daemon=True).start()
+    stop.wait()
+    proxy.end()
+    results.put({f'proxy_{key}': value for key, value in proxy.stats().items()})
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _send_packages(client, plan, payload, destination):
+    for size, reliable in plan:
+        client.send_data(payload[:size], Client._DATAGRAM_RELIABLE if reliable else Client._DATAGRAM_NORMAL,
+                         destination)
+
+
+def run(args):
+    generator = random.Random(args.seed)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.payload == 'text':
+        # Compressible payload, JSON like records
+        records = ''.join(f'{{"id": {i}, "value": {generator.randrange(1000)}}}, ' for i in range(max(sizes) // 24 + 1))
+        payload = memoryview(records.encode()[:max(sizes)])
+    else:
+        payload = memoryview(generator.randbytes(max(sizes)))
+    plans = [[(generator.choice(sizes), generator.random() < args.reliable_ratio) for _ in range(args.packages)]
+             for _ in range(args.clients)]
+    impairments = {'loss': args.loss, 'duplicate': args.duplicate, 'reorder': args.reorder,
+                   'delay': args.delay_ms / 1000, 'jitter': args.jitter_ms / 1000, 'seed': args.seed}
+
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_run_server, args=[args.port, stop, results])
+    proxy = multiprocessing.Process(target=_run_proxy, args=[args.port + 1, args.port, impairments, stop, results])
+    server.start()
+    proxy.start()
+    time.sleep(0.5)
+
+    latencies = []
+
+    def on_event(event, info):
+        if event == 'package_acknowledged':
+            latencies.append(info['latency'])
+
+    clients = []
+    for i in range(args.clients):
+        client = Client(address='localhost', address_port=args.port + 1, local_port=args.port + 10 + i,
+                        integrity=_INTEGRITY[args.integrity], chunk_size=args.chunk_size,
+                        compression=_COMPRESSION[args.compression], sack=args.sack)
+        client.add_hook(on_event)
+        clients.append(client)
+
+    cpu_started = time.process_time()
+    started = time.time()
+    senders = [Thread(target=_send_packages, args=[client, plan, payload, ('localhost', args.port + 1)])
+               for client, plan in zip(clients, plans)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    flushed = all(client.flush(args.timeout) for client in clients)
+    elapsed = time.time() - started
+    client_cpu = time.process_time() - cpu_started
+
+    # NORMAL packages are not acknowledged, give the last ones time to arrive
+    time.sleep(0.5)
+    stop.set()
+    collected = {}
+    for _ in range(2):
+        collected.update(results.get())
+    server.join()
+    proxy.join()
+    for client in clients:
+        client.close()
+
+    client_stats = [client.stats() for client in clients]
+    packages_sent = sum(len(plan) for plan in plans)
+    report = {
+        'packages_sent': packages_sent,
+        'reliable_packages_sent': sum(reliable for plan in plans for _, reliable in plan),
+        'bytes_sent': sum(size for plan in plans for size, _ in plan),
+        'delivered_packages': collected['delivered_packages'],
+        'delivered_bytes': collected['delivered_bytes'],
+        'delivery_rate': collected['delivered_packages'] / packages_sent if packages_sent else 0.0,
+        'flushed': flushed,
+        'elapsed_seconds': elapsed,
+        'throughput_mbps': collected['delivered_bytes'] * 8 / elapsed / 1e6,
+        'latency_p50_ms': None,
+        'latency_p99_ms': None,
+        'datagrams_sent': sum(stats['datagrams_sent'] for stats in client_stats),
+        'retransmissions': sum(stats['retransmissions'] for stats in client_stats),
+        'fast_retransmissions': sum(stats['fast_retransmissions'] for stats in client_stats),
+        'chunks_given_up': sum(stats['chunks_given_up'] for stats in client_stats),
+        'packages_failed': sum(stats['packages_failed'] for stats in client_stats),
+        'compressed_packages': sum(stats['compressed_packages'] for stats in client_stats),
+        'compression_saved_bytes': sum(stats['compression_saved_bytes'] for stats in client_stats),
+        'client_cpu_seconds': client_cpu,
+        'server_cpu_seconds': collected['server_cpu_seconds'],
+        'server_datagrams_dropped': collected['server_datagrams_dropped'],
+        'server_hash_failures': collected['server_hash_failures'],
+        'server_decompression_failures': collected['server_decompression_failures'],
+    }
+    if latencies:
+        report['latency_p50_ms'] = _percentile(latencies, 0.5) * 1000
+        report['latency_p99_ms'] = _percentile(latencies, 0.99) * 1000
+    report.update(sorted((key, value) for key, value in collected.items() if key.startswith('proxy_')))
+    report['arguments'] = vars(args)
+    return report
+
+
+def _print_report(report, previous=None):
+    for key, value in report.items():
+        if key == 'arguments':
+            continue
+        line = f'{key:28} {value:.3f}' if isinstance(value, float) else f'{key:28} {value}'
+        before = previous.get(key) if previous else None
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and isinstance(before, (int, float)) \
+                and before:
+            line += f'   ({(value - before) / before * 100:+.1f}% vs {before:.3f})'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TapNet throughput and latency benchmark over a lossy proxy')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--packages', type=int, default=50, help='packages sent by every client')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='payload sizes in bytes, comma separated')
+    parser.add_argument('--reliable-ratio', type=float, default=1.0, help='fraction of RELIABLE packages')
+    parser.add_argument('--integrity', choices=sorted(_INTEGRITY), default='sha256')
+    parser.add_argument('--chunk-size', type=int, default=2048)
+    parser.add_argument('--compression', choices=sorted(_COMPRESSION), default='none')
+    parser.add_argument('--sack', action='store_true', help='ask the server for selective ACKs')
+    parser.add_argument('--payload', choices=['random', 'text'], default='random',
+                        help='random bytes or compressible text')
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--duplicate', type=float, default=0.0)
+    parser.add_argument('--reorder', type=float, default=0.0)
+    parser.add_argument('--delay-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=10500, help='server port, the proxy and clients use the next ones')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for the ACKs of every client')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--compare', help='report of a previous run to compare with')
+    args = parser.parse_args()
+
+    report = run(args)
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    _print_report(report, previous)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
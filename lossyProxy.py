@@ -0,0 +1,123 @@
+import argparse
+import heapq
+import logging
+import random
+import select
+import time
+from socket import socket, AF_INET, SOCK_DGRAM
+
+_logger = logging.getLogger(__name__)
+
+
+# UDP proxy that impairs the traffic between clients and a server: loss, duplication, reordering and delay.
+# Clients send to the proxy port, every client gets its own upstream socket so that the server replies (ACKs) can
+# be routed back to it. Impairments apply in both directions and are reproducible for a given seed.
+
+class LossyProxy:
+    _BUFFER_SIZE = 65535
+
+    # loss, duplicate and reorder are probabilities per datagram. Reordered datagrams are held reorder_delay
+    # seconds more than the rest, delay and jitter are in seconds too.
+    def __init__(self, listen_address, target_address, loss=0.0, duplicate=0.0, reorder=0.0, delay=0.0, jitter=0.0,
+                 reorder_delay=0.005, seed=None):
+        self.listen_address = listen_address
+        self.target_address = target_address
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder_delay = reorder_delay
+        self._random = random.Random(seed)
+        self._socket = socket(AF_INET, SOCK_DGRAM)
+        # client address -> upstream socket, and back
+        self._upstreams = {}
+        self._clients = {}
+        # Datagrams waiting for their release time: (release_time, sequence, socket, data, address)
+        self._delayed = []
+        self._sequence = 0
+        self._is_closed = False
+        self.forwarded = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    def start(self):
+        self._socket.bind(self.listen_address)
+        _logger.info('Proxy %s -> %s', self.listen_address, self.target_address)
+        self._loop()
+
+    def end(self):
+        self._is_closed = True
+
+    def stats(self):
+        return {
+            'forwarded': self.forwarded,
+            'dropped': self.dropped,
+            'duplicated': self.duplicated,
+            'reordered': self.reordered,
+        }
+
+    def _loop(self):
+        while not self._is_closed:
+            timeout = 0.1
+            if self._delayed:
+                timeout = min(max(self._delayed[0][0] - time.time(), 0), timeout)
+            readable, _, _ = select.select([self._socket, *self._clients], [], [], timeout)
+            for sock in readable:
+                data, address = sock.recvfrom(self._BUFFER_SIZE)
+                if sock is self._socket:
+                    self._impair(self._upstream(address), data, self.target_address)
+                else:
+                    self._impair(self._socket, data, self._clients[sock])
+            now = time.time()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, sock, data, address = heapq.heappop(self._delayed)
+                sock.sendto(data, address)
+
+    def _upstream(self, client_address):
+        upstream = self._upstreams.get(client_address)
+        if upstream is None:
+            upstream = self._upstreams[client_address] = socket(AF_INET, SOCK_DGRAM)
+            self._clients[upstream] = client_address
+        return upstream
+
+    def _impair(self, sock, data, address):
+        if self._random.random() < self.loss:
+            self.dropped += 1
+            return
+        copies = 1
+        if self._random.random() < self.duplicate:
+            self.duplicated += 1
+            copies = 2
+        for _ in range(copies):
+            delay = self.delay + self._random.uniform(0, self.jitter)
+            if self._random.random() < self.reorder:
+                self.reordered += 1
+                delay += self.reorder_delay
+            self.forwarded += 1
+            if delay <= 0:
+                sock.sendto(data, address)
+                continue
+            self._sequence += 1
+            heapq.heappush(self._delayed, (time.time() + delay, self._sequence, sock, data, address))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='UDP proxy that injects loss, duplication, reordering and delay')
+    parser.add_argument('--listen-port', type=int, default=10001)
+    parser.add_argument('--target-port', type=int, default=10000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--duplicate', type=float, default=0.0)
+    parser.add_argument('--reorder', type=float, default=0.0)
+    parser.add_argument('--delay-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    proxy = LossyProxy((args.host, args.listen_port), (args.host, args.target_port), loss=args.loss,
+                       duplicate=args.duplicate, reorder=args.reorder, delay=args.delay_ms / 1000,
+                       jitter=args.jitter_ms / 1000, seed=args.seed)
+    proxy.start()
@@ -1,13 +1,17 @@
+import logging
+
 from TapNet.netLibrary import Client
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     client = Client(address='localhost', address_port=10000, local_port=11000)
 
+    # The file is streamed from disk, it is never read whole into memory
     with open("test-image.jpg", mode='rb') as file:
-        fileContent = file.read()
+        client.send_data(file, 2, ('localhost', 10000))
+        client.send_data(file, 1, ('localhost', 10000))
+        client.send_data(file, 2, ('localhost', 10000))
 
-        client.send_data(fileContent, 2, ('localhost', 10000))
-        client.send_data(fileContent, 1, ('localhost', 10000))
-        client.send_data(fileContent, 2, ('localhost', 10000))
+    client.close()
 
     # Todo: Cambiar que cuando se quedan esperando los acks, siga enviando más paquetes
@@ -1,3 +1,5 @@
+import logging
+
 from TapNet.netLibrary import Server
 
 
@@ -7,6 +9,7 @@ def on_image_received(data):
 
 
 if __name__ == "__main__":
-    server = Server(address='localhost', port=10000, handler=on_image_received)
+    logging.basicConfig(level=logging.INFO)
+    server = Server(address='localhost', port=10000, handler=on_image_received, handler_workers=1)
 
     server.start()
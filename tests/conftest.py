@@ -0,0 +1,40 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import TapNet.datagramIO
+from TapNet.netLibrary import Server
+
+
+@pytest.fixture(params=['batched', 'fallback'])
+def io_mode(request, monkeypatch):
+    # DatagramIO picks recvmmsg/sendmmsg or the recvfrom_into drain when it is created, after this fixture runs
+    if request.param == 'batched' and TapNet.datagramIO._libc is None:
+        pytest.skip('recvmmsg/sendmmsg are not available')
+    if request.param == 'fallback':
+        monkeypatch.setattr(TapNet.datagramIO, '_libc', None)
+    return request.param
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(server_class=Server, **options):
+    server = server_class('localhost', free_port(), **options)
+    threading.Thread(target=server.start, daemon=True).start()
+    deadline = time.time() + 5
+    while server._io is None and time.time() < deadline:
+        time.sleep(0.01)
+    return server
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
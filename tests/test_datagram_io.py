@@ -0,0 +1,69 @@
+import socket
+
+from TapNet.datagramIO import DatagramIO
+
+
+def _bound_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('localhost', 0))
+    return sock
+
+
+def _socket_pair():
+    return _bound_socket(), _bound_socket()
+
+
+def _receive(io, count):
+    received = []
+    while len(received) < count:
+        # The views are overwritten by the next call
+        received.extend((bytes(datagram), address) for datagram, address in io.recv_batch())
+    return received
+
+
+def test_loopback_round_trip(io_mode):
+    sender, receiver = _socket_pair()
+    with sender, receiver:
+        sending = DatagramIO(sender)
+        receiving = DatagramIO(receiver, buffer_size=1024, batch_size=8)
+        assert sending.batched == receiving.batched == (io_mode == 'batched')
+
+        datagrams = [((b'header-%d|' % i, b'payload' * i), receiver.getsockname()) for i in range(40)]
+        sending.send_batch(datagrams)
+        received = _receive(receiving, len(datagrams))
+
+        assert [data for data, _ in received] == [b''.join(buffers) for buffers, _ in datagrams]
+        assert {address for _, address in received} == {sender.getsockname()}
+
+
+def test_recv_batch_returns_queued_datagrams(io_mode):
+    sender, receiver = _socket_pair()
+    with sender, receiver:
+        for i in range(5):
+            sender.sendto(bytes([i]) * 10, receiver.getsockname())
+        io = DatagramIO(receiver, buffer_size=64, batch_size=16)
+        # Everything already queued comes back from one call
+        batch = [bytes(datagram) for datagram, _ in io.recv_batch()]
+
+        assert batch == [bytes([i]) * 10 for i in range(5)]
+
+
+def test_empty_datagram(io_mode):
+    sender, receiver = _socket_pair()
+    with sender, receiver:
+        io = DatagramIO(receiver)
+        sender.sendto(b'', receiver.getsockname())
+
+        assert _receive(io, 1) == [(b'', sender.getsockname())]
+
+
+def test_batch_to_more_peers_than_the_address_cache(io_mode, monkeypatch):
+    monkeypatch.setattr(DatagramIO, '_ADDRESS_CACHE_SIZE', 2)
+    receivers = [_bound_socket() for _ in range(8)]
+    with _bound_socket() as sender:
+        # The address cache is cleared in the middle of the batch
+        DatagramIO(sender).send_batch([((b'to %d' % i,), receiver.getsockname())
+                                       for i, receiver in enumerate(receivers)])
+        for i, receiver in enumerate(receivers):
+            with receiver:
+                assert _receive(DatagramIO(receiver), 1) == [(b'to %d' % i, sender.getsockname())]
@@ -0,0 +1,64 @@
+import threading
+import time
+
+from TapNet.handlerPool import HandlerPool, BACKPRESSURE_PAUSE_ACKS
+from TapNet.netLibrary import Client
+
+from conftest import free_port, start_server, wait_for
+
+
+def test_handler_pool_handles_queued_packages_on_close():
+    handled = []
+
+    def handler(data):
+        time.sleep(0.05)
+        handled.append(data)
+
+    pool = HandlerPool(handler, workers=1, queue_size=16)
+    for i in range(5):
+        pool.submit(i)
+    pool.close()
+
+    assert handled == list(range(5))
+    pool.submit(5)
+    assert pool.stats()['handler_dropped'] == 1
+
+
+def test_handler_pool_close_timeout_drops_the_rest():
+    pool = HandlerPool(lambda data: time.sleep(0.2), workers=1, queue_size=16)
+    for i in range(5):
+        pool.submit(i)
+    pool.close(timeout=0.1)
+
+    # One package is being handled when the timeout expires, at most one more is taken after it
+    assert pool.stats()['handler_dropped'] >= 3
+
+
+def test_pause_acks_drops_packages_that_were_not_acknowledged():
+    release = threading.Event()
+    pool = HandlerPool(lambda data: release.wait(5), workers=1, queue_size=2, backpressure=BACKPRESSURE_PAUSE_ACKS)
+    for i in range(3):
+        pool.submit(i)
+    assert wait_for(lambda: pool.stats()['handler_queue_depth'] == 2)
+
+    pool.submit('normal', acknowledged=False)
+    pool.submit('reliable')
+    stats = pool.stats()
+    assert stats['handler_dropped'] == 1 and stats['handler_queue_depth'] == 3
+    release.set()
+    pool.close()
+
+
+def test_normal_packages_keep_the_queue_bounded():
+    release = threading.Event()
+    server = start_server(handler=lambda data: release.wait(10), handler_workers=1, handler_queue_size=4,
+                          backpressure=BACKPRESSURE_PAUSE_ACKS)
+    client = Client('localhost', server.port, free_port())
+    for i in range(200):
+        client.send_data(b'normal %d' % i, Client._DATAGRAM_NORMAL, ('localhost', server.port))
+    assert wait_for(lambda: server.stats()['handler_dropped'] > 0)
+    time.sleep(0.2)
+
+    assert server.stats()['handler_queue_depth'] <= 4
+    release.set()
+    client.close(1)
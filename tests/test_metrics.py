@@ -0,0 +1,33 @@
+from TapNet.metrics import Metrics
+from TapNet.netLibrary import Client
+
+from conftest import free_port, start_server, wait_for
+
+
+def _failing_hook(event, info):
+    raise RuntimeError(event)
+
+
+def test_failing_hook_does_not_stop_the_others():
+    metrics = Metrics({})
+    events = []
+    metrics.add_hook(_failing_hook)
+    metrics.add_hook(lambda event, info: events.append((event, info)))
+
+    metrics.emit('package_completed', size=1)
+
+    assert events == [('package_completed', {'size': 1})]
+
+
+def test_failing_hook_does_not_stop_the_client_and_server():
+    received = []
+    server = start_server(handler=received.append)
+    server.add_hook(_failing_hook)
+    client = Client('localhost', server.port, free_port())
+    client.add_hook(_failing_hook)
+
+    for _ in range(2):
+        client.send_data(b'data' * 1000, Client._DATAGRAM_RELIABLE, ('localhost', server.port))
+        assert client.flush(5)
+    assert wait_for(lambda: len(received) == 2)
+    client.close(1)
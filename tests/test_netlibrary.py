@@ -0,0 +1,168 @@
+import hashlib
+import io
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from TapNet.netLibrary import Client, COMPRESSION_ZLIB, INTEGRITY_NONE, _COMPRESSION_SHIFT, _HEADER, _ReassemblyStore
+
+from conftest import free_port, start_server, wait_for
+
+_RELIABLE = Client._DATAGRAM_RELIABLE
+
+# Type byte first, shorter than the header or than the control datagram of that type
+_TRUNCATED = [b'', b'\x00', b'\x00' * 5, b'\x01', b'\x02', b'\x02\x03' + bytes(20), b'\x03', b'\x04\x00\x00',
+              b'\x05\x00', b'\x06']
+
+
+def _client(server, **options):
+    return Client('localhost', server.port, free_port(), **options)
+
+
+def test_reliable_package(io_mode):
+    received = []
+    server = start_server(handler=received.append)
+    client = _client(server)
+    data = os.urandom(200_000)
+
+    client.send_data(data, _RELIABLE, ('localhost', server.port))
+
+    assert client.flush(10)
+    assert wait_for(lambda: received)
+    assert bytes(received[0]) == data
+    client.close(1)
+
+
+def test_reliable_packages_are_not_evicted():
+    received = []
+    server = start_server(handler=lambda data: received.append(hashlib.md5(data).hexdigest()),
+                          max_buffer_memory=1_500_000)
+    clients = [_client(server, chunk_size=1024) for _ in range(3)]
+    packages = [os.urandom(1_000_000) for _ in clients]
+
+    senders = [threading.Thread(target=client.send_data, args=(data, _RELIABLE, ('localhost', server.port)))
+               for client, data in zip(clients, packages)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+
+    # Only two packages fit at a time, the third one is refused (not acknowledged) until memory is released
+    assert all(client.flush(60) for client in clients)
+    assert wait_for(lambda: len(received) == len(packages))
+    assert sorted(received) == sorted(hashlib.md5(data).hexdigest() for data in packages)
+    assert server.stats()['evicted_packages'] == 0
+    for client in clients:
+        client.close(1)
+
+
+def test_reassembly_store_evicts_only_normal_packages():
+    store = _ReassemblyStore(max_memory=25_000, package_timeout=60)
+    normal = store.create('normal', 10, 1000)
+    reliable = store.create('reliable', 10, 1000, reliable=True)
+    assert normal is not None and reliable is not None
+
+    # The normal package makes room, the reliable one is kept and the new one refused
+    assert store.create('second', 10, 1000, reliable=True) is not None
+    assert 'normal' not in store and store.is_discarded('normal')
+    assert store.create('third', 10, 1000, reliable=True) is None
+    assert 'reliable' in store and 'second' in store
+    assert store.evicted_packages == 1
+
+
+@pytest.mark.parametrize('compression', [0, COMPRESSION_ZLIB])
+def test_file_position_is_kept(compression):
+    client = Client(compression=compression)
+    data = b'0123456789' * 10_000
+    file = io.BytesIO(data)
+    file.seek(10)
+
+    for _ in range(3):
+        payload, used = client._compress_payload(file)
+        assert file.tell() == 10
+        _, chunks = client._split(payload)
+        assert b''.join(chunks) == (data[10:] if used == 0 else payload)
+        assert file.tell() == 10
+
+
+def test_stream_size_is_checked_before_allocating():
+    store = _ReassemblyStore(max_memory=1_000_000, package_timeout=60)
+
+    assert store.create('huge', 0xFFFFFFF0, 1024, streaming=True) is None
+    assert store.memory_used == 0
+    stream = store.create('small', 100, 1024, streaming=True)
+    # The received bitmap is counted
+    assert store.memory_used == stream.size == 100
+
+
+def test_crafted_stream_header_is_dropped():
+    ranges = []
+    server = start_server(stream_handler=lambda *args: ranges.append(args))
+    header = _HEADER.pack(Client._DATAGRAM_NORMAL, INTEGRITY_NONE, 1024, 1, bytes(32), 0xFFFFFFF0, 1)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(header + bytes(1024), ('localhost', server.port))
+    assert wait_for(lambda: server.stats()['datagrams_dropped'] == 1)
+
+    assert server.stats()['reassembly_memory'] == 0
+    assert not ranges
+
+
+@pytest.mark.parametrize('sack', [False, True])
+def test_truncated_datagrams_are_dropped(io_mode, sack):
+    received = []
+    server = start_server(handler=received.append)
+    client = _client(server, sack=sack)
+    client._bound_socket()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for datagram in _TRUNCATED:
+            sock.sendto(datagram, ('localhost', server.port))
+            sock.sendto(datagram, ('localhost', client._local_port))
+    assert wait_for(lambda: server.stats()['datagrams_dropped'] == len(_TRUNCATED))
+
+    # Both the listen loop and the dispatcher are still running
+    client.send_data(b'still alive' * 1000, _RELIABLE, ('localhost', server.port))
+    assert client.flush(10)
+    assert wait_for(lambda: received)
+    client.close(1)
+
+
+def test_chunks_of_a_corrupt_compressed_stream_are_not_acknowledged():
+    ranges = []
+    server = start_server(stream_handler=lambda *args: ranges.append(args))
+    options = INTEGRITY_NONE | COMPRESSION_ZLIB << _COMPRESSION_SHIFT
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('localhost', 0))
+        sock.settimeout(0.5)
+        for subpackage_id in range(3):
+            # The first chunk is not a zlib stream
+            header = _HEADER.pack(_RELIABLE, options, 1024, 7, bytes(32), 3, subpackage_id)
+            sock.sendto(header + b'\xff' * 1024, ('localhost', server.port))
+            if subpackage_id == 0:
+                assert sock.recv(64)[:1] == bytes([Client._DATAGRAM_ACK])
+        with pytest.raises(socket.timeout):
+            sock.recv(64)
+
+    assert server.stats()['decompression_failures'] == 1
+    # Only the discard reaches the handler
+    assert [args[1:] for args in ranges] == [(0, None, True)]
+
+
+def test_stream_handler_learns_of_a_discarded_package():
+    ranges = []
+    server = start_server(stream_handler=lambda uid, offset, data, completed:
+                          ranges.append((offset, data and bytes(data), completed)),
+                          package_timeout=0.2)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        header = _HEADER.pack(Client._DATAGRAM_NORMAL, INTEGRITY_NONE, 1024, 1, bytes(32), 3, 0)
+        sock.sendto(header + b'a' * 1024, ('localhost', server.port))
+        assert wait_for(lambda: ranges)
+        time.sleep(0.3)
+        # Packages expire as datagrams arrive
+        header = _HEADER.pack(Client._DATAGRAM_NORMAL, INTEGRITY_NONE, 1024, 2, bytes(32), 3, 0)
+        sock.sendto(header + b'b' * 1024, ('localhost', server.port))
+        assert wait_for(lambda: len(ranges) == 3)
+
+    assert ranges == [(0, b'a' * 1024, False), (1024, None, True), (0, b'b' * 1024, False)]
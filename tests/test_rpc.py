@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from TapNet.netLibrary import Client
+from TapNet.rpc import RpcClient, RpcServer, _RPC, _RPC_REPLY
+
+from conftest import free_port, start_server
+
+
+def test_rpc_call_to_silent_server_times_out():
+    client = RpcClient('localhost', free_port(), free_port(), call_timeout=0.5)
+    started = time.time()
+    future = client.call(b'ping')
+
+    with pytest.raises(TimeoutError):
+        future.result(5)
+    assert time.time() - started < 2
+    assert client.stats()['call_timeouts'] == 1
+    client.close(1)
+
+
+def test_cancelled_calls_are_skipped():
+    release = threading.Event()
+
+    def handler(data):
+        release.wait(5)
+        return bytes(data[::-1])
+
+    server = start_server(RpcServer, handler=handler)
+    client = RpcClient('localhost', server.port, free_port(), call_timeout=1)
+    cancelled = client.call(b'abc')
+    assert cancelled.cancel()
+    release.set()
+
+    # Its reply arrives after the cancel, the receive thread goes on with the next call
+    assert client.call(b'xyz').result(5) == b'zyx'
+    assert client._dispatcher_thread.is_alive()
+
+    # Cancelled calls that expire are skipped too
+    release.clear()
+    expired = client.call(b'late')
+    assert expired.cancel()
+    time.sleep(1.2)
+    release.set()
+    assert client.call(b'!').result(5) == b'!'
+    client.close(1)
+
+
+def test_replies_from_other_peers_are_ignored():
+    release = threading.Event()
+
+    def handler(data):
+        release.wait(5)
+        return b'from the server'
+
+    server = start_server(RpcServer, handler=handler)
+    client = RpcClient('localhost', server.port, free_port(), call_timeout=5)
+    future = client.call(b'ping')
+    stranger = Client('localhost', client._local_port, free_port())
+
+    # Same call_id, sent from an address the call did not go to
+    stranger.send_data(_RPC.pack(_RPC_REPLY, 0) + b'forged', Client._DATAGRAM_RELIABLE,
+                       ('localhost', client._local_port))
+    assert stranger.flush(5)
+    release.set()
+    assert future.result(5) == b'from the server'
+    stranger.close(1)
+    client.close(1)
@@ -0,0 +1,25 @@
+from TapNet.tapnet import TapNet
+
+from conftest import free_port, wait_for
+
+
+def test_tapnet_batches_and_discovers_chunk_size(io_mode):
+    received = []
+    receiver = TapNet(('localhost', free_port()), received.append)
+    receiver.start()
+    sender = TapNet(('localhost', free_port()), send_options={
+        'batch_size': 1000, 'address': 'localhost', 'address_port': receiver.address[1],
+        'discover_chunk_size': True})
+    sender.start()
+    # The probe replies were read by the listen loop
+    assert sender._client._chunk_size > TapNet.CHUNK_SIZE
+
+    for i in range(20):
+        sender.send_bytes(b'message %d' % i, TapNet.DATAGRAM_RELIABLE, receiver.address)
+    # Under batch_size, the linger thread sends the batch
+    assert wait_for(lambda: len(received) == 20, timeout=5)
+    assert sender.stats()['sent']['batches_sent'] == 1
+
+    sender.close(1)
+    receiver.close(1)
+    assert not sender._listen_thread.is_alive() and not sender._check_thread.is_alive()